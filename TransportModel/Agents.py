@@ -3,7 +3,9 @@ import mesa
 from dataclasses import dataclass
 from enum import Enum
 
-@dataclass
+from event_trace import MOVE
+
+@dataclass(slots=True)
 class Location:
     x: int
     y: int
@@ -17,6 +19,7 @@ class StepType(Enum):
     QUEUE = 1
     CLOSEST = 2
     WAITING = 3
+    BATCH = 4 # all idle drivers assigned at once by TransportModel.assign_batch
 
 
 class DestVis(mesa.Agent):
@@ -30,24 +33,39 @@ class DestVis(mesa.Agent):
 class Passenger(mesa.Agent):
     """An agent with starting location and target destination"""
 
-    def __init__(self, unique_id, model, grid_width, grid_height, x, y, step, seed, secondary_id, waiting_time, num_people = 1):
+    # slots for mesa.Agent's attributes too, so every attribute is stored in a slot; mesa.Agent has no
+    # __slots__, so instances still have a __dict__, but it stays empty and is only allocated if
+    # something sets an attribute that isn't listed here
+    __slots__ = ("unique_id", "model", "pos", "type", "src", "dest", "num_people", "waiting_time", "remove",
+                 "shortest_distance", "request_time", "pickup_time", "dropoff_time", "latest_pickup_time", "secondary_id")
+
+    def __init__(self, unique_id, model, grid_width, grid_height, x, y, step, seed, secondary_id, waiting_time, num_people = 1, dest=None, patience=None):
         super().__init__(unique_id, model)
         self.type = "Passenger"
+        roads = model.roads
         self.src = Location(x, y)
-        self.dest = Location(seed.randrange(grid_width),seed.randrange(grid_height))
-        while self.src == self.dest:
-            self.dest = Location(seed.randrange(grid_width),seed.randrange(grid_height))
+        # dest and patience are given when the request comes from a demand stream, otherwise drawn here;
+        # on a road network either is moved onto the closest node
+        if dest is not None:
+            self.dest = Location(*roads.snap(*dest))
+        else:
+            self.dest = Location(*roads.snap(seed.randrange(grid_width),seed.randrange(grid_height)))
+            while self.src == self.dest:
+                self.dest = Location(*roads.snap(seed.randrange(grid_width),seed.randrange(grid_height)))
         self.num_people = num_people
-        print(f"Agent {unique_id}: {self.src} to {self.dest}")
-        if waiting_time:
-            self.waiting_time = self.random.randint(waiting_time,waiting_time+10)
+        if patience is not None:
+            self.waiting_time = patience
         else:
-            self.waiting_time = self.random.randint(10,40)
+            rng = model.patience_rng or self.random
+            if waiting_time:
+                self.waiting_time = rng.randint(waiting_time,waiting_time+10)
+            else:
+                self.waiting_time = rng.randint(10,40)
 
         self.remove = False
 
         # for metrics
-        self.shortest_distance =  abs(self.src.x - self.dest.x) + abs(self.src.y - self.dest.y)
+        self.shortest_distance = roads.distance(self.src, self.dest)
         self.request_time = step
         self.pickup_time = -1
         self.dropoff_time = -1
@@ -58,11 +76,11 @@ class Passenger(mesa.Agent):
     def step(self):
         # passenger leaves if past waiting time
         if self.pos and (self.model.schedule.steps > self.latest_pickup_time):
-            print(f"Waited too long - passenger {self.unique_id} has left", self.model.schedule.steps, self.latest_pickup_time)
             if self in self.model.clients:
                 self.model.clients.remove(self)
             self.model.schedule.remove(self)
             self.model.grid.remove_agent(self)
+            self.model.on_abandon(self)
             
 
         # remove next cycle
@@ -79,6 +97,10 @@ class Passenger(mesa.Agent):
 class Driver(mesa.Agent):
     """An agent with starting location and target destination"""
 
+    # as for Passenger, attributes live in slots and the inherited __dict__ stays empty
+    __slots__ = ("unique_id", "model", "pos", "type", "step_type", "current", "current_routes", "_timing", "passengers",
+                 "max_passengers", "dest_vis", "multi_pass", "detour_max", "steps_taken", "idle_time")
+
     def __init__(self, unique_id, model, x, y, multi_pass, max_passengers=4, step_type = StepType.QUEUE):
         self.model = model
         super().__init__(unique_id, model)
@@ -87,6 +109,7 @@ class Driver(mesa.Agent):
         self.current =  Location(x, y)
 
         self.current_routes = [] # list of target destinations based on passengers in car and target passenger and corrseponding passenger
+        self._timing = None # cached route timing for get_passengers, see route_timing
         self.set_next_dest(self.model.clients)
         self.passengers = [] # passengers actually in car
         self.max_passengers = max_passengers
@@ -110,147 +133,76 @@ class Driver(mesa.Agent):
 
     def check_arrival_lte_waiting(self, passenger):
         # check if able to reach passenger dest in time, otherwise ignore
-        arrival_time = self.calc_manhattan(self.current, passenger.src) + self.model.schedule.steps
+        arrival_time = self.model.roads.distance(self.current, passenger.src) + self.model.schedule.steps
         return arrival_time <= passenger.latest_pickup_time
 
 
-    def calc_manhattan(self, src, dest):
-        return abs(src.x - dest.x) + abs(src.y - dest.y)
-        
-
-    def find_closest(self, from_loc, passengers):
-        # helper functions for assigning next passenger to car when car has no passengers
-        closest = passengers[0]
-        min_distance = self.calc_manhattan(passengers[0].src, from_loc)
-        for p_dests in passengers:
-            curr_dist = self.calc_manhattan(p_dests.src, from_loc)
-            if min_distance > curr_dist:
-                min_distance = curr_dist
-                closest = p_dests
-        return closest
-    
-    def find_closest_waiting(self, passengers):
-        # helper functions for assigning next passenger to car when car has no passengers
-        most_urgent = passengers[0]
-        min_waiting = passengers[0].latest_pickup_time
-        for passenger in passengers:
-            curr_wait = passenger.latest_pickup_time
-            if min_waiting > curr_wait:
-                min_waiting = curr_wait
-                most_urgent = passenger
-        return most_urgent
-    
-
     def set_next_dest(self, clients):
         # find new passengers when car has no passengers
-        if clients:
-            copy_clients = clients
+        if self.step_type == StepType.BATCH:
+            return # assigned together with the rest of the fleet by the model
+        while clients:
             if self.step_type == StepType.WAITING:
-                passenger = self.find_closest_waiting(copy_clients)
+                passenger = clients.most_urgent()
             elif self.step_type == StepType.QUEUE:
-                passenger = copy_clients[0]
+                passenger = clients.earliest()
             else:
-                passenger = self.find_closest(self.current, copy_clients)
-            
+                roads = self.model.roads
+                passenger = clients.nearest(self.current, None if roads.manhattan else roads.distance)
 
-            # skip passenger if not able to reach passenger location in time
-            if not self.check_arrival_lte_waiting(passenger):
-                copy_clients.remove(passenger)
-                self.set_next_dest(copy_clients)
-            else:
+            # passenger is either taken or, if not able to reach passenger location in time, skipped for good
+            clients.remove(passenger)
+            if self.check_arrival_lte_waiting(passenger):
                 self.current_routes = [(passenger.src, passenger), (passenger.dest, passenger)]
-                self.model.clients.remove(passenger)
+                return
 
 
 
     def move(self):
-        target = self.current_routes[0][0]
-        if self.current.x != target.x or self.current.y != target.y:
-            self.steps_taken += 1
-
-        if self.current.x < target.x:
-            self.current = Location(self.current.x+1, self.current.y)
-        elif self.current.x > target.x:
-            self.current = Location(self.current.x-1, self.current.y)
-        elif self.current.y < target.y:
-            self.current = Location(self.current.x, self.current.y+1)
-        elif self.current.y > target.y:
-            self.current = Location(self.current.x, self.current.y-1)
-        else:
+        # one cell along the way to the next waypoint, as laid out by model.roads
+        cell = self.model.roads.next_step(self.current, self.current_routes[0][0])
+        if cell is None:
             return
+        self.steps_taken += 1
+
+        # self.current is only ever held by this driver, so it is moved in place
+        self.current.x, self.current.y = cell
 
         self.model.grid.move_agent(self, (self.current.x, self.current.y))
+        if self.model.trace:
+            self.model.trace.emit(self.model.schedule.steps, MOVE, self.unique_id, -1, self.current.x, self.current.y)
 
         # pickup and drop off passengers enroute
         if self.multi_pass and len(self.passengers) < self.max_passengers:
             self.get_passengers()
        
 
-    def is_enroute(self, from_loc, to, between):
-        if min(from_loc.x, to.x) <= between.x <= max(from_loc.x, to.x) and min(from_loc.y, to.y) <= between.y <= max(from_loc.y, to.y):
-            return True
-        return False
-
- 
-
 
     def search_square(self):
-        # search between self.current and target and retrieve all passengers in this area
-        target = self.current_routes[0][0]
-
-        from_x = min(target.x, self.current.x)
-        to_x = target.x if from_x == self.current.x else self.current.x
+        # waiting passengers between self.current and target, from the model's reverse index of route legs
+        # (on a road network the way there can leave this rectangle, passengers off it are not considered)
+        current_route_passengers = {passenger for (_, passenger) in self.current_routes}
+        area_passengers = [passenger for passenger in self.model.route_index.candidates(self) if passenger not in current_route_passengers]
+        # ties in order_passengers go to the earliest request
+        return sorted(area_passengers, key=lambda p: p.unique_id)
 
-        from_y = min(target.y, self.current.y)
-        to_y = target.y if from_y == self.current.y else self.current.y
 
-        potential_passengers = []
-        for i in range(from_x, to_x + 1):
-            for j in range(from_y, to_y+1):
-                this_cell = self.model.grid.get_cell_list_contents([(i, j)])
-                potential_passengers.extend([obj for obj in this_cell if isinstance(obj, Passenger)])
 
-        # filter out passengers that are already in current_routes
-        current_route_passengers = [passenger for (_, passenger) in self.current_routes]
 
-        potential_passengers = [passenger for passenger in potential_passengers if passenger in self.model.clients]
-        area_passengers  = list(set(potential_passengers) - set(current_route_passengers))
-        return area_passengers  
-    
-
-    
-
-
-    def earliest_request(self, passengers):
-        # helper functions for finding passenger with earliest request time
-        min_passenger = passengers[0]
-        min_request = passengers[0].request_time
-        for passenger in passengers:
-            if min_request > passenger.request_time:
-                min_request = passenger.request_time
-                min_passenger = passenger
-        return min_passenger
-                  
-        
     def order_passengers(self, passengers):
-        # order passengers according to strategy
-        ordered_passengers = []
-        while passengers:
-            if self.step_type == StepType.WAITING:
-                p = self.find_closest_waiting(passengers)
-            elif self.step_type == StepType.QUEUE:
-                p = self.earliest_request(passengers)
-            else:
-                p = self.find_closest(self.current, passengers)
-            ordered_passengers.append(p)
-            passengers.remove(p)
-
-        return ordered_passengers
+        # order passengers according to strategy, ties keep their order in passengers
+        if self.step_type == StepType.WAITING:
+            return sorted(passengers, key=lambda p: p.latest_pickup_time)
+        elif self.step_type == StepType.QUEUE:
+            return sorted(passengers, key=lambda p: p.request_time)
+        return sorted(passengers, key=lambda p: self.model.roads.distance(self.current, p.src))
     
 
 
     def get_passengers(self):
-      
+        roads = self.model.roads
+        distance = roads.distance
+
         area_passengers = self.search_square()
         ordered_passengers = self.order_passengers(area_passengers)
 
@@ -258,17 +210,17 @@ class Driver(mesa.Agent):
            
 
             # can't pick up in time, so skip
-            if passenger.latest_pickup_time <  self.calc_manhattan(self.current, passenger.src) + self.model.schedule.steps: 
+            if passenger.latest_pickup_time <  distance(self.current, passenger.src) + self.model.schedule.steps: 
                 continue
 
             # check if can insert passenger src between current and OG target
             src_index = -1
 
-            if self.is_enroute(self.current, self.current_routes[0][0], passenger.src):
+            if roads.is_enroute(self.current, self.current_routes[0][0], passenger.src):
                 src_index = 0
             else:
                 for i in range(len(self.current_routes)-1):
-                    if self.is_enroute(self.current_routes[i][0], self.current_routes[i+1][0], passenger.src): 
+                    if roads.is_enroute(self.current_routes[i][0], self.current_routes[i+1][0], passenger.src): 
                         src_index = i + 1
 
                         break
@@ -284,11 +236,10 @@ class Driver(mesa.Agent):
             # if drop off enroute, no disruption for existing passengers
 
             # check if enroute possible
-            if self.is_enroute(passenger.src, self.current_routes[src_index][0], passenger.dest):
+            if roads.is_enroute(passenger.src, self.current_routes[src_index][0], passenger.dest):
                 if passenger in self.model.clients:
                     self.model.clients.remove(passenger)
-                    self.current_routes.insert(src_index, (passenger.src, passenger))
-                    self.current_routes.insert(src_index+1, (passenger.dest, passenger))
+                    self.insert_passenger(passenger, src_index, src_index+1)
                 # move on to next passenger in list
                 added= True
 
@@ -296,78 +247,104 @@ class Driver(mesa.Agent):
 
 
             for i in range(src_index, len(self.current_routes)-1):
-                if self.is_enroute(self.current_routes[i][0], self.current_routes[i+1][0], passenger.dest): 
+                if roads.is_enroute(self.current_routes[i][0], self.current_routes[i+1][0], passenger.dest): 
                     if passenger in self.model.clients:
                         self.model.clients.remove(passenger)
-                        self.current_routes.insert(src_index, (passenger.src, passenger))
-                        self.current_routes.insert(src_index+2, (passenger.dest, passenger))
-                        # print(passenger.unique_id, self.current_routes)
+                        self.insert_passenger(passenger, src_index, src_index+2)
                     added= True
                     break
 
 
             # if need to detour, find one such that latest arrival time satisfied, and adds least detour to car
             if not added and passenger in self.model.clients:
-        
-                original_distance = self.calc_manhattan(passenger.src, self.current_routes[src_index][0])
-                new_dist =  self.calc_manhattan(passenger.src, passenger.dest) +  self.calc_manhattan(passenger.dest, self.current_routes[src_index][0])
-                detours = [(new_dist - original_distance, src_index)]
-                for i in range(src_index, len(self.current_routes)-1):
-                    original_distance = self.calc_manhattan(self.current_routes[i][0], self.current_routes[i+1][0])
-                    new_dist =  self.calc_manhattan(self.current_routes[i][0], passenger.dest) +  self.calc_manhattan(passenger.dest, self.current_routes[i+1][0])
-                    detours.append((new_dist - original_distance, i+1))
-
+                routes = self.current_routes
+                prefix, slack, min_slack = self.route_timing()
+
+                detours = [(distance(passenger.src, passenger.dest) + distance(passenger.dest, routes[src_index][0])
+                            - distance(passenger.src, routes[src_index][0]), src_index)]
+                for i in range(src_index, len(routes)-1):
+                    new_dist = distance(routes[i][0], passenger.dest) + distance(passenger.dest, routes[i+1][0])
+                    detours.append((new_dist - (prefix[i+1] - prefix[i]), i+1))
+
+                # the car reaches waypoint k at start + prefix[k]
+                start = self.model.schedule.steps + distance(self.current, routes[0][0]) - prefix[0]
+                time = start + prefix[max(src_index-1, 0)] + distance(routes[src_index-1][0], passenger.src)
+                # time goes up to passenger src
 
-                time = self.model.schedule.steps + self.calc_manhattan(self.current, self.current_routes[0][0])
-                for i in range(src_index-1):
-                    time += self.calc_manhattan(self.current_routes[i][0], self.current_routes[i+1][0])
+                # least slack of the pickups after src_index and before each waypoint
+                before = [float("inf")] * (len(routes) + 1)
+                for k in range(src_index+1, len(routes)):
+                    before[k+1] = min(before[k], slack[k])
 
-                time += self.calc_manhattan(self.current_routes[src_index-1][0], passenger.src)
-                # time goes up to passenger src
+                # a pickup is late if its slack is below the delay pushed onto it, so each placing is checked in O(1)
                 to_add = True
                 index= None
-
-                while detours:
-                    detour_tuple = min(detours, key=lambda x: x[0])
-
-                    detours.remove(detour_tuple)
-                    detour = detour_tuple[0]
+                for detour, candidate in sorted(detours):
                     if detour > self.detour_max:
                         break
 
-                    index = detour_tuple[1]
-                    new_time = time
+                    index = candidate
                     to_add = True
                     if index == src_index:
-                        new_time += self.calc_manhattan(passenger.src, passenger.dest)
-                        new_time += self.calc_manhattan(passenger.dest, self.current_routes[src_index][0])
-                        if self.current_routes[src_index][1].latest_pickup_time < new_time: # constraint not satisfied, check new placing
+                        new_time = time + distance(passenger.src, passenger.dest) + distance(passenger.dest, routes[src_index][0])
+                        if routes[src_index][1].latest_pickup_time < new_time: # constraint not satisfied, check new placing
                             continue
+                        to_add = min_slack[src_index+1] >= new_time - prefix[src_index]
                     else:
-                        new_time += self.calc_manhattan(passenger.src, self.current_routes[src_index][0])
-                       
-
-                    for j in range(src_index, len(self.current_routes)-1):
-                        if j == index-1:
-                            new_time += self.calc_manhattan(self.current_routes[j][0], passenger.dest)
-                            new_time += self.calc_manhattan(passenger.dest, self.current_routes[j+1][0])
-                        else:
-                            new_time += self.calc_manhattan(self.current_routes[j][0], self.current_routes[j+1][0])
-                        curr_passenger = self.current_routes[j+1][1]
-                        if curr_passenger.src == self.current_routes[j+1][0]: # if src, check constraints
-                            if curr_passenger.latest_pickup_time < new_time: # constraint not satisfied, check new placing
-                                to_add = False
-                                break
-                    
+                        delay = time + distance(passenger.src, routes[src_index][0]) - prefix[src_index]
+                        to_add = before[index] >= delay and min_slack[index] >= delay + detour
+
                     if to_add:
                         break
                 if to_add and index is not None:
                     self.model.clients.remove(passenger)
-                    self.current_routes.insert(src_index, (passenger.src, passenger))
-                    self.current_routes.insert(index+1, (passenger.dest, passenger))
-
-              
-
+                    self.insert_passenger(passenger, src_index, index+1)
+
+
+
+    def route_timing(self):
+        # prefix[k]: route length from the first waypoint to waypoint k, offset by the legs already driven
+        # slack[k]: latest_pickup_time - prefix[k] for a pickup waypoint, inf for a drop off
+        # min_slack[k]: least slack from waypoint k to the end of the route
+        # rebuilt only when current_routes is replaced, pop_waypoint and insert_passenger keep it up to date
+        if self._timing is None or self._timing[0] is not self.current_routes or len(self._timing[1]) != len(self.current_routes):
+            self._timing = (self.current_routes, [], [], [])
+            self._update_timing(0)
+        return self._timing[1:]
+
+
+    def _update_timing(self, start):
+        # recompute the timing from waypoint start on, the earlier waypoints are unchanged
+        routes, prefix, slack, min_slack = self._timing
+        distance = self.model.roads.distance
+        del prefix[start:], slack[start:]
+        for k in range(start, len(routes)):
+            prefix.append(prefix[k-1] + distance(routes[k-1][0], routes[k][0]) if k else 0)
+            loc, passenger = routes[k]
+            slack.append(passenger.latest_pickup_time - prefix[k] if passenger.src == loc else float("inf"))
+        min_slack[:] = slack + [float("inf")]
+        for k in range(len(routes) - 1, -1, -1):
+            min_slack[k] = min(min_slack[k], min_slack[k+1])
+
+
+    def pop_waypoint(self):
+        # reached the first waypoint; the remaining prefixes keep their offset, so the timing only loses its head
+        if self._timing is not None and self._timing[0] is self.current_routes and len(self._timing[1]) == len(self.current_routes):
+            for values in self._timing[1:]:
+                del values[0]
+        waypoint = self.current_routes.pop(0)
+        if not self.current_routes:
+            # an idle car has no leg for route_index to keep clients for
+            self.model.route_index.unregister(self)
+        return waypoint
+
+
+    def insert_passenger(self, passenger, src_index, dest_index):
+        # src is inserted at src_index, then dest at dest_index of the longer route
+        self.route_timing()
+        self.current_routes.insert(src_index, (passenger.src, passenger))
+        self.current_routes.insert(dest_index, (passenger.dest, passenger))
+        self._update_timing(src_index)
 
 
     def pickup_passenger(self):
@@ -375,7 +352,7 @@ class Driver(mesa.Agent):
         potential_passengers = [obj for obj in this_cell if isinstance(obj, Passenger)]
 
         if not potential_passengers:
-            self.current_routes.pop(0)
+            self.pop_waypoint()
 
 
 
@@ -387,15 +364,18 @@ class Driver(mesa.Agent):
                 self.model.grid.remove_agent(passenger)
                 self.passengers.append(passenger)
                  # remove loc from current routes
-                self.current_routes.pop(0)
+                self.pop_waypoint()
 
-                # place destination vis
-                dest_v = DestVis(self.model.next_id(), self.model, passenger.unique_id)
+                # place destination vis, unless nothing will draw it
+                dest_v = None
+                if self.model.show_destinations:
+                    dest_v = DestVis(self.model.next_id(), self.model, passenger.unique_id)
+                    self.model.grid.place_agent(dest_v, (passenger.dest.x, passenger.dest.y))
                 self.dest_vis.append(dest_v)
-                self.model.grid.place_agent(dest_v, (passenger.dest.x, passenger.dest.y))
 
                 # metrics
                 passenger.pickup_time = self.model.schedule.steps
+                self.model.on_pickup(passenger, self)
 
             if not self.multi_pass:
                 break
@@ -408,9 +388,10 @@ class Driver(mesa.Agent):
         if len(self.dest_vis) == 1:
             return 0
         index = 0
-        min_distance = self.calc_manhattan(self.passengers[0].dest, self.current)
+        distance = self.model.roads.distance
+        min_distance = distance(self.current, self.passengers[0].dest)
         for i, passenger in enumerate(self.passengers):
-            curr_dist = self.calc_manhattan(passenger.dest, self.current)
+            curr_dist = distance(self.current, passenger.dest)
             if min_distance > curr_dist:
                 min_distance = curr_dist
                 index = i
@@ -421,7 +402,7 @@ class Driver(mesa.Agent):
     def drop_off_passengers(self):
         
         # remove locations from current routes
-        _, passenger = self.current_routes.pop(0)
+        _, passenger = self.pop_waypoint()
 
         passenger_id = passenger.unique_id
         
@@ -436,11 +417,13 @@ class Driver(mesa.Agent):
             return
 
         passenger = self.passengers.pop(pass_index)
-        self.model.grid.remove_agent(self.dest_vis[pass_index]) # remove dest from grid
+        if self.dest_vis[pass_index] is not None:
+            self.model.grid.remove_agent(self.dest_vis[pass_index]) # remove dest from grid
         self.dest_vis.pop(pass_index)
         
         # metrics
         passenger.dropoff_time = self.model.schedule.steps
+        self.model.on_dropoff(passenger, self)
        
        
 
@@ -448,7 +431,7 @@ class Driver(mesa.Agent):
     def step_algo(self):
         # if at destination point
         while self.current_routes and self.current.x == self.current_routes[0][0].x and self.current.y == self.current_routes[0][0].y:            
-            print(f"Agent {self.unique_id} Reached Destination {self.current}", self.model.schedule.steps)
+            self.model.on_arrival(self)
             if self.current_routes[0][1].dest == self.current_routes[0][0]:
                     self.drop_off_passengers()
 
@@ -1,109 +1,327 @@
 import mesa
+import numpy as np
 import random
 
-from Agents import Passenger, Driver
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError: # only needed for StepType.BATCH
+    linear_sum_assignment = None
 
-def compute_manhattan(model):
-    total_dist = 0
-    for agent in model.schedule.agents:
-        if type(agent) == "Driver":
-            print(total_dist)
-            total_dist += abs(agent.current.x - agent.next_dest.x) + abs(agent.current.y - agent.next_dest.y)
-    return total_dist
+from Agents import Passenger, Driver, StepType
+from clients import ClientPool
+from grids import SparseGrid
+from demand import draw_secondary_id, load_demand, rng_streams
+from event_schedule import EventActivation
+from two_phase import TwoPhaseActivation
+from kpis import KPITracker, KPI_REPORTERS
+import event_trace
+from event_trace import EventTrace
+from profiling import PhaseProfiler
+from roads import OpenGrid, load_road_network
+from route_index import RouteIndex
+from steady_state import SteadyState
+from trip_records import TripRecorder, DROPPED_OFF, ABANDONED, UNFINISHED
 
 class TransportModel(mesa.Model):
     """A model with some number of agents."""
 
-    def __init__(self, num_drivers, size, multi_pass, seed_int, strategy, waiting_time, rate, total_steps=0):
+    def __init__(self, num_drivers, size, multi_pass, seed_int, strategy, waiting_time, rate, total_steps=0, event_driven=False, trip_file=None, agent_data=True, trace_file=None,
+                 profile=False, profile_window=None, profile_file=None, demand=None,
+                 show_destinations=True, sparse_grid=False, road_network=None,
+                 two_phase=False, workers=0, replication=None, steady_state=None):
         super().__init__()
 
+        if strategy == StepType.BATCH and linear_sum_assignment is None:
+            raise ImportError("StepType.BATCH needs scipy")
+
         self.num_drivers = num_drivers
-        self.grid = mesa.space.MultiGrid(size, size, False)
-        self.schedule = mesa.time.RandomActivation(self)
+        self.strategy = strategy
+        # sparse grid only stores occupied cells, for maps too large to allocate cell by cell
+        self.grid = SparseGrid(size, size) if sparse_grid else mesa.space.MultiGrid(size, size, False)
+        # distances and routes: manhattan on the open grid, or shortest paths over a roads.RoadNetwork
+        # (or an edge list file for roads.load_road_network) whose nodes are cells of the grid
+        self.roads = OpenGrid()
+        if road_network is not None:
+            self.roads = load_road_network(road_network) if isinstance(road_network, str) else road_network
+            if self.roads.cells.max() >= size:
+                raise ValueError(f"road network does not fit on a {size}x{size} grid")
+        # event driven schedule only wakes agents that have something to do, with the same results
+        # (it still shuffles every agent each step, so it gains most with sparse demand);
+        # two phase dispatches idle drivers together, across workers processes, and steps in a fixed order
+        if two_phase and event_driven:
+            raise ValueError("two_phase and event_driven can't be combined")
+        if two_phase:
+            self.schedule = TwoPhaseActivation(self, workers)
+        else:
+            self.schedule = EventActivation(self) if event_driven else mesa.time.RandomActivation(self)
         self.running = True
-        self.clients = []
+        self.clients = ClientPool() # waiting passengers, spatially indexed for CLOSEST dispatch
+        self.route_index = RouteIndex(self.clients) # which multi passenger drivers pass each waiting passenger
         self.drivers = []
-        self.seed = random.Random(seed_int)
+        # by default requests draw from seed, patience and activation order from mesa's rng; with a
+        # replication number each of the three has its own stream, so strategies compared on one
+        # seed and replication see the same requests with the same patience (see demand.rng_streams)
+        self.patience_rng = None
+        if replication is None:
+            self.seed = random.Random(seed_int)
+        else:
+            self.seed, self.patience_rng, self.random = rng_streams(seed_int, replication)
         self.waiting_time = waiting_time
 
         self.total_steps = total_steps
         self.rate = rate
 
-        secondary_id = 0
-        if self.total_steps:
-            self.num_range = range(1, total_steps//self.rate + num_drivers + 1)
-            
+        # DestVis markers for passengers in a car, only needed when the grid is drawn
+        self.show_destinations = show_destinations
 
+        self.kpis = KPITracker() # running totals and stats, updated by the on_* hooks
 
-        # Create passenger agents
-        for _ in range(self.num_drivers):
-            # Add the agent to a random grid cell
-            x = self.seed.randrange(self.grid.width)
-            y = self.seed.randrange(self.grid.height)
-            # secondary id
-            if total_steps:
-                secondary_id = self.seed.choice(self.num_range)
-                # Remove the chosen number from the range
-                num_list = list(self.num_range)
-                num_list.remove(secondary_id)
-                self.num_range = range(num_list[0], num_list[-1] + 1)
-            a = Passenger(self.next_id(), self, self.grid.width, self.grid.height, x, y, self.schedule.steps, self.seed, secondary_id, self.waiting_time)
-            self.schedule.add(a)
+        # one row per finished passenger and per driver, written out by finish() (see there for when it runs)
+        self.trips = None
+        if trip_file:
+            self.trips = TripRecorder(trip_file, meta={
+                "num_drivers": num_drivers, "size": size, "multi_pass": multi_pass, "seed_int": seed_int,
+                "strategy": strategy, "waiting_time": waiting_time, "rate": rate, "total_steps": total_steps})
 
-            self.clients.append(a)
-            self.grid.place_agent(a, (x, y))
+        # binary record of every request, pickup, drop off and move, for replay with event_trace.TraceReplay
+        self.trace = EventTrace(trace_file, size, size) if trace_file else None
+        # phase timings and gauges, switched on with profile; see profiling.PhaseProfiler
+        self.profiler = None
+
+        # requests come from a demand.Demand (or a file saved by demand.save_demand) when given,
+        # otherwise they are drawn from seed as they arrive
+        self.demand = load_demand(demand) if isinstance(demand, str) else demand
+        self._demand_row = 0 # first row of demand not yet requested
 
-            
+        # Create passenger agents
+        if self.demand is not None:
+            self.add_requests()
+        else:
+            if self.total_steps:
+                self.num_range = range(1, total_steps//self.rate + num_drivers + 1)
+            for _ in range(self.num_drivers):
+                self.add_request()
 
         # Create driver agents
         for i in range(self.num_drivers):
-            # Add the agent to a random grid cell
-            x = self.seed.randrange(self.grid.width)
-            y = self.seed.randrange(self.grid.height)
+            if self.demand is not None and self.demand.drivers is not None:
+                x, y = (int(v) for v in self.demand.drivers[i])
+            else:
+                # Add the agent to a random grid cell
+                x = self.seed.randrange(self.grid.width)
+                y = self.seed.randrange(self.grid.height)
+            x, y = self.roads.snap(x, y)
             a = Driver(self.next_id(), self, x, y, multi_pass, step_type=strategy)
             self.schedule.add(a)
             self.drivers.append(a)
             self.grid.place_agent(a, (x, y))
+            if self.trace:
+                self.trace.emit(self.schedule.steps, event_trace.DRIVER, a.unique_id, -1, x, y)
 
-       
+        if self.strategy == StepType.BATCH:
+            self.assign_batch()
 
-        self.datacollector = mesa.DataCollector(
-            model_reporters={"Manhattan": compute_manhattan},
-            agent_reporters={
-            "Steps": lambda a: a.steps_taken if a.type == "Driver" else None,
-            "IdleTime": lambda b: b.idle_time if b.type == "Driver" else None,
-            "sec_id": lambda b: b.secondary_id if b.type == "Passenger" else None,
-            "request_time": lambda b: b.request_time if b.type == "Passenger" else None,
-            "pickup_time": lambda b: b.pickup_time if b.type == "Passenger" else None,
-            "dropoff_time": lambda b: b.dropoff_time if b.type == "Passenger" else None,
-            "shortest distance": lambda b: b.shortest_distance if b.type == "Passenger" else None,
+        # per step agent snapshots are only needed for the notebooks, a sweep can keep just the KPIs
+        self.agent_data = agent_data
+        self.datacollector = self.make_datacollector()
 
+        if profile:
+            self.profiler = PhaseProfiler(profile_window, profile_file)
+            self.profiler.attach(self)
+
+        # stop the run once backlog, waiting time and utilisation have settled: True for the
+        # defaults or a steady_state.SteadyState; its warm up cut is reported with the KPIs
+        self.steady_state = SteadyState() if steady_state is True else steady_state or None
+
+    def make_datacollector(self):
+        agent_reporters = None
+        if self.agent_data:
+            agent_reporters = {
+                "Steps": lambda a: a.steps_taken if a.type == "Driver" else None,
+                "IdleTime": lambda b: b.idle_time if b.type == "Driver" else None,
+                "sec_id": lambda b: b.secondary_id if b.type == "Passenger" else None,
+                "request_time": lambda b: b.request_time if b.type == "Passenger" else None,
+                "pickup_time": lambda b: b.pickup_time if b.type == "Passenger" else None,
+                "dropoff_time": lambda b: b.dropoff_time if b.type == "Passenger" else None,
+                "shortest distance": lambda b: b.shortest_distance if b.type == "Passenger" else None,
             }
-        )
+        return mesa.DataCollector(model_reporters=KPI_REPORTERS, agent_reporters=agent_reporters)
+
+    def __getstate__(self):
+        # everything but the reporters, which are lambdas; see checkpoint.save_checkpoint
+        if self.profiler:
+            raise ValueError("can't checkpoint a profiled model")
+        if self.trace and not self.trace.closed:
+            raise ValueError("can't checkpoint a model writing an event trace")
+        state = self.__dict__.copy()
+        collector = self.datacollector
+        state["datacollector"] = {"model_vars": collector.model_vars, "_agent_records": collector._agent_records, "tables": collector.tables}
+        return state
+
+    def __setstate__(self, state):
+        collected = state.pop("datacollector")
+        self.__dict__.update(state)
+        self.datacollector = self.make_datacollector()
+        self.datacollector.__dict__.update(collected)
+
+    def configure(self, strategy=None, multi_pass=None):
+        # switch strategy or multi_pass mid run, e.g. on branches forked from one warmed up state
+        if strategy is not None:
+            if strategy == StepType.BATCH and linear_sum_assignment is None:
+                raise ImportError("StepType.BATCH needs scipy")
+            self.strategy = strategy
+            for driver in self.drivers:
+                driver.step_type = strategy
+            if self.trips:
+                self.trips.meta["strategy"] = strategy
+        if multi_pass is not None:
+            if self.trips:
+                self.trips.meta["multi_pass"] = multi_pass
+            event_driven = isinstance(self.schedule, EventActivation)
+            if event_driven:
+                self.schedule.sync()
+            for driver in self.drivers:
+                driver.multi_pass = multi_pass
+                if not multi_pass:
+                    self.route_index.unregister(driver)
+                elif event_driven and driver.current_routes:
+                    # a sleeping car is only woken for clients on its leg
+                    self.route_index.register(driver, driver.current_routes[0][0])
+
+    def add_passenger(self, x, y, secondary_id, dest=None, patience=None):
+        x, y = self.roads.snap(x, y)
+        if dest is not None and self.roads.snap(*dest) == (x, y):
+            # a trip that starts and ends on the same cell, or road node once snapped, is left out:
+            # its pickup would be taken for the drop off
+            return
+        a = Passenger(self.next_id(), self, self.grid.width, self.grid.height, x, y, self.schedule.steps, self.seed, secondary_id, self.waiting_time,
+                      dest=dest, patience=patience)
+        self.schedule.add(a)
+        self.clients.append(a)
+        self.route_index.add(a)
+        self.grid.place_agent(a, (x, y))
+        self.on_request(a)
+
+    def add_request(self):
+        # Create new passenger agent in a random grid cell
+        x = self.seed.randrange(self.grid.width)
+        y = self.seed.randrange(self.grid.height)
+        secondary_id = 0
+        if self.total_steps:
+            secondary_id, self.num_range = draw_secondary_id(self.seed, self.num_range)
+        self.add_passenger(x, y, secondary_id)
+
+    def add_requests(self):
+        # passengers of the demand stream whose step has come up
+        rows, self._demand_row = self.demand.rows(self._demand_row, self.schedule.steps)
+        for _, x, y, dest_x, dest_y, waiting_time, secondary_id in rows.tolist():
+            self.add_passenger(x, y, secondary_id, dest=(dest_x, dest_y), patience=waiting_time if waiting_time >= 0 else None)
+
+    def assign_batch(self):
+        # match every idle driver to a waiting passenger in one go, minimising total pickup distance
+        idle = [driver for driver in self.drivers if not driver.current_routes]
+        if not idle or not self.clients:
+            return
+        passengers = list(self.clients)
+
+        latest = np.array([passenger.latest_pickup_time for passenger in passengers])
+        cost = self.roads.distance_matrix([driver.current for driver in idle], [passenger.src for passenger in passengers])
+        feasible = cost + self.schedule.steps <= latest # same test as check_arrival_lte_waiting
+        if not feasible.any():
+            return
+
+        # unreachable pairs cost more than any set of reachable ones, so as many as possible are served
+        cost = np.where(feasible, cost, cost.max() * min(cost.shape) + 1)
+        rows, cols = linear_sum_assignment(cost)
+        for row, col in zip(rows, cols):
+            if feasible[row, col]:
+                passenger = passengers[col]
+                idle[row].current_routes = [(passenger.src, passenger), (passenger.dest, passenger)]
+                self.clients.remove(passenger)
+
+    def on_request(self, passenger):
+        self.kpis.on_request(passenger)
+        if self.profiler:
+            self.profiler.attach_passenger(passenger)
+        if self.trace:
+            steps = self.schedule.steps
+            self.trace.emit(steps, event_trace.REQUEST, passenger.unique_id, -1, passenger.src.x, passenger.src.y)
+            self.trace.emit(steps, event_trace.DESTINATION, passenger.unique_id, -1, passenger.dest.x, passenger.dest.y)
+
+    def on_pickup(self, passenger, driver):
+        self.kpis.on_pickup(passenger)
+        if self.trace:
+            self.trace.emit(self.schedule.steps, event_trace.PICKUP, passenger.unique_id, driver.unique_id, passenger.src.x, passenger.src.y)
+
+    def on_dropoff(self, passenger, driver):
+        self.kpis.on_dropoff(passenger)
+        if self.trips and not self.trips.closed:
+            self.trips.passenger_done(passenger, DROPPED_OFF)
+        if self.trace:
+            self.trace.emit(self.schedule.steps, event_trace.DROPOFF, passenger.unique_id, driver.unique_id, passenger.dest.x, passenger.dest.y)
+
+    def on_abandon(self, passenger):
+        self.kpis.on_abandon(passenger)
+        if self.trips and not self.trips.closed:
+            self.trips.passenger_done(passenger, ABANDONED)
+        if self.trace:
+            self.trace.emit(self.schedule.steps, event_trace.ABANDON, passenger.unique_id, -1, passenger.src.x, passenger.src.y)
+
+    def on_arrival(self, driver):
+        if self.trace:
+            self.trace.emit(self.schedule.steps, event_trace.ARRIVAL, driver.unique_id, -1, driver.current.x, driver.current.y)
+
+    def finish(self):
+        # end of run: record passengers still waiting or riding and every driver, write the trips, close the trace
+        # and stop running, so mesa.batch_run doesn't step on. Called by step when total_steps is reached or the run
+        # stops at a steady state; a caller that stops stepping any other way (total_steps=0, its own step limit)
+        # must call it itself. Safe to call again.
+        self.running = False
+        if isinstance(self.schedule, EventActivation):
+            # where every car ended up and its counters, which lag behind while it sleeps
+            self.schedule.sync()
+        if self.trips and not self.trips.closed:
+            for agent in self.schedule.agents:
+                if agent.type == "Passenger" and agent.dropoff_time == -1:
+                    self.trips.passenger_done(agent, UNFINISHED)
+            for driver in self.drivers:
+                self.trips.driver_done(driver)
+            self.trips.close()
+        if self.trace:
+            # where every car ended up, as sleeping cars of the event driven schedule have gaps in their moves
+            for driver in self.drivers:
+                self.trace.emit(self.schedule.steps - 1, event_trace.MOVE, driver.unique_id, -1, driver.current.x, driver.current.y)
+            self.trace.close()
+            # a model stepped on anyway records nothing more
+            self.trace = None
+        if self.profiler:
+            self.profiler.stop()
+        if isinstance(self.schedule, TwoPhaseActivation):
+            self.schedule.close()
 
     def step(self):
+        if self.agent_data and isinstance(self.schedule, EventActivation):
+            # the per driver counters are collected every step
+            self.schedule.sync()
         self.datacollector.collect(self)
         
+        if self.strategy == StepType.BATCH:
+            self.assign_batch()
         self.schedule.step()
-        if (self.schedule.steps % self.rate == 0):
-            # Create new passenger agent
-            x = self.seed.randrange(self.grid.width)
-            y = self.seed.randrange(self.grid.height)
-            secondary_id = 0
+        if self.demand is not None:
+            self.add_requests()
+        elif (self.schedule.steps % self.rate == 0):
+            self.add_request()
 
-            if self.total_steps:
-                secondary_id = self.seed.choice(self.num_range)
-                # Remove the chosen number from the range
-                num_list = list(self.num_range)
-                num_list.remove(secondary_id)
-                self.num_range = range(num_list[0], num_list[-1] + 1)
-
-            a = Passenger(self.next_id(), self, self.grid.width, self.grid.height, x, y, self.schedule.steps, self.seed, secondary_id, self.waiting_time)
-            
-            self.schedule.add(a)
-            self.clients.append(a)
-            self.grid.place_agent(a, (x, y))
-      
+        if self.running and self.steady_state and self.steady_state.observe(self):
+            self.finish()
 
+        if self.total_steps and self.schedule.steps == self.total_steps:
+            self.finish()
 
-        
+
+def seeded_model(seed, **params):
+    # TransportModel with mesa's own rng seeded too, so runs with the same seed do the same work
+    model = TransportModel.__new__(TransportModel, seed=seed)
+    model.__init__(**params)
+    return model
@@ -0,0 +1,135 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import mesa
+import numpy as np
+
+from TransportModel import seeded_model
+from Agents import StepType
+from sweep import expand
+
+# scaling grid, every combination is one case
+GRID = {
+    "num_drivers": [5, 20],
+    "size": [15, 50],
+    "rate": [1, 5],
+    "strategy": [StepType.QUEUE, StepType.CLOSEST, StepType.WAITING],
+    "multi_pass": [False, True],
+}
+
+# cases aimed at known hot spots
+STRESS = {
+    # few cars and patient passengers, so the waiting backlog handed to order_passengers keeps growing
+    "stress_backlog": {"num_drivers": 2, "size": 30, "rate": 1, "strategy": StepType.WAITING,
+                       "multi_pass": True, "waiting_time": 500},
+    # ten cars fall behind on a big map: hundreds of patient passengers are shuffled and stepped
+    # every step, and get_passengers weighs the many route_index candidates along each long leg
+    "stress_large_grid": {"num_drivers": 10, "size": 200, "rate": 1, "strategy": StepType.CLOSEST,
+                          "multi_pass": True, "waiting_time": 300},
+    # full cars on long routes, exercising the detour loop in get_passengers
+    "stress_long_routes": {"num_drivers": 5, "size": 60, "rate": 1, "strategy": StepType.QUEUE,
+                           "multi_pass": True, "waiting_time": 200},
+    # city scale map, only possible with the sparse grid
+    "stress_city_grid": {"num_drivers": 1000, "size": 5000, "rate": 1, "strategy": StepType.CLOSEST,
+                         "multi_pass": True, "waiting_time": 200, "sparse_grid": True, "show_destinations": False},
+}
+
+
+def cases():
+    # name -> TransportModel arguments, for the scaling grid and the stress cases
+    all_cases = {}
+    for run in expand(GRID):
+        run.pop("iteration")
+        name = "d{num_drivers}_s{size}_r{rate}_{strategy.name}_{mp}".format(mp="multi" if run["multi_pass"] else "single", **run)
+        all_cases[name] = dict(run, waiting_time=30)
+    all_cases.update(STRESS)
+    return all_cases
+
+
+def run_case(params, steps, seed=1, repeat=1, memory=True, event_driven=False):
+    """Time steps of a headless model, keeping the fastest of repeat runs.
+
+    Returns steps/sec, per step latency percentiles in milliseconds and, with memory,
+    the tracemalloc peak in MiB from a separate run, as tracing slows the model down.
+    """
+    params = dict(params, seed_int=seed, event_driven=event_driven, agent_data=False)
+    best = None
+    for _ in range(repeat):
+        model = seeded_model(seed, **params)
+        latencies = np.empty(steps)
+        for i in range(steps):
+            start = time.perf_counter()
+            model.step()
+            latencies[i] = time.perf_counter() - start
+        if best is None or latencies.sum() < best.sum():
+            best = latencies
+
+    result = {
+        "steps": steps,
+        "steps_per_sec": steps / best.sum(),
+        "p50_ms": 1000 * np.percentile(best, 50),
+        "p95_ms": 1000 * np.percentile(best, 95),
+        "p99_ms": 1000 * np.percentile(best, 99),
+        "max_ms": 1000 * best.max(),
+    }
+
+    if memory:
+        tracemalloc.start()
+        model = seeded_model(seed, **params)
+        for _ in range(steps):
+            model.step()
+        result["peak_mib"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, threshold):
+    # names of cases whose throughput fell more than threshold (a fraction) below the baseline
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result["steps_per_sec"] < (1 - threshold) * base["steps_per_sec"]:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ridesharing simulation headless')
+
+    parser.add_argument('--steps', type=int, default=300, help='Steps per case')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the fastest is kept')
+    parser.add_argument('--filter', type=str, required=False, help='Only run cases whose name contains this')
+    parser.add_argument('--no_memory', action='store_true', help='Skip the tracemalloc peak memory run')
+    parser.add_argument('--event_driven', action='store_true', help='Use the event driven schedule')
+    parser.add_argument('--save', type=str, required=False, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, required=False, help='JSON results of an earlier run to check against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed drop in steps/sec against the baseline, as a fraction')
+
+    args = parser.parse_args()
+
+    results = {}
+    for name, params in cases().items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_case(params, args.steps, repeat=args.repeat, memory=not args.no_memory,
+                                 event_driven=args.event_driven)
+        r = results[name]
+        print(f"{name:32} {r['steps_per_sec']:10.1f} steps/s  p50 {r['p50_ms']:7.3f} ms  p95 {r['p95_ms']:7.3f} ms"
+              f"  p99 {r['p99_ms']:7.3f} ms" + (f"  peak {r['peak_mib']:7.2f} MiB" if "peak_mib" in r else ""))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "mesa": mesa.__version__, "cases": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["cases"]
+        regressions = compare(results, baseline, args.threshold)
+        for name in regressions:
+            print(f"REGRESSION {name}: {results[name]['steps_per_sec']:.1f} steps/s, baseline {baseline[name]['steps_per_sec']:.1f}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import pickle
+import traceback
+
+from kpis import KPI_REPORTERS
+
+
+def save_checkpoint(model, path):
+    """Write the whole state of model to path: agents, routes, clients, schedule and every rng.
+
+    The file is written under a temporary name and renamed, so a checkpoint on disk is
+    always complete. Models writing an event trace or running a profiler can't be saved.
+    """
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    # model saved by save_checkpoint, ready to step on from where it was saved
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def report(model):
+    # KPI columns of a model, as a sweep shard has them, with the steady state ones if it looks for one
+    row = dict(Step=model.schedule.steps, **{name: reporter(model) for name, reporter in KPI_REPORTERS.items()})
+    if getattr(model, "steady_state", None):
+        row.update(model.steady_state.report())
+    return row
+
+
+def fork_map(model, tasks, processes=None):
+    """Call every task(model) in its own forked child and return the results in order.
+
+    Each child starts from a copy-on-write copy of model as it is now, so warm up state is
+    shared instead of rebuilt, and tasks can change and step their copy freely. At most
+    processes children run at once, all of them by default. Linux and macOS only.
+    """
+    processes = processes or len(tasks)
+    results = [None] * len(tasks)
+    for start in range(0, len(tasks), processes):
+        running = []
+        for index in range(start, min(start + processes, len(tasks))):
+            recv, send = multiprocessing.Pipe(duplex=False)
+            pid = os.fork()
+            if pid == 0:
+                recv.close()
+                code = 0
+                try:
+                    send.send((True, tasks[index](model)))
+                except BaseException:
+                    send.send((False, traceback.format_exc()))
+                    code = 1
+                finally:
+                    os._exit(code)
+            send.close()
+            running.append((index, pid, recv))
+
+        for index, pid, recv in running:
+            ok, result = recv.recv()
+            os.waitpid(pid, 0)
+            if not ok:
+                raise RuntimeError(f"forked task {index} failed:\n{result}")
+            results[index] = result
+    return results
+
+
+def fork_branches(model, branches, until, processes=None):
+    """KPIs of branches run from the current state of model, each in a forked child.
+
+    Every branch is a dict of TransportModel.configure arguments, e.g. {"strategy":
+    StepType.QUEUE}, applied before its copy steps on to step until.
+    """
+    def task(branch):
+        def run(model):
+            model.configure(**branch)
+            while model.running and model.schedule.steps < until:
+                model.step()
+            model.finish()
+            return report(model)
+        return run
+
+    return fork_map(model, [task(branch) for branch in branches], processes)
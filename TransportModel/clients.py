@@ -0,0 +1,152 @@
+import heapq
+
+
+class ClientPool:
+    """Waiting passengers in arrival order, with a bucketed spatial index on their pickup location
+    and heaps ordered by latest pickup time and by request time.
+
+    Stands in for the plain ``model.clients`` list: ``append``, ``remove``, ``in``,
+    iteration and ``clients[0]`` behave the same, and every change also updates the indexes.
+    Heap entries of removed passengers are dropped lazily when they reach the top.
+    """
+
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self._seq = {} # passenger -> arrival sequence number, kept in arrival order
+        self._next_seq = 0
+        self._buckets = {} # (bucket x, bucket y) -> {passenger: seq}
+        self._by_deadline = [] # (latest_pickup_time, seq, passenger)
+        self._by_request = [] # (request_time, seq, passenger)
+
+
+    def _bucket_key(self, loc):
+        return (loc.x // self.bucket_size, loc.y // self.bucket_size)
+
+
+    def append(self, passenger):
+        seq = self._next_seq
+        self._next_seq += 1
+        self._seq[passenger] = seq
+        self._buckets.setdefault(self._bucket_key(passenger.src), {})[passenger] = seq
+        heapq.heappush(self._by_deadline, (passenger.latest_pickup_time, seq, passenger))
+        heapq.heappush(self._by_request, (passenger.request_time, seq, passenger))
+
+
+    def remove(self, passenger):
+        # same contract as list.remove
+        if passenger not in self._seq:
+            raise ValueError("passenger not in clients")
+        del self._seq[passenger]
+        key = self._bucket_key(passenger.src)
+        bucket = self._buckets[key]
+        del bucket[passenger]
+        if not bucket:
+            del self._buckets[key]
+
+        # rebuild the heaps once stale entries outnumber live ones
+        if len(self._by_deadline) > 2 * len(self._seq) + 64:
+            self._by_deadline = [entry for entry in self._by_deadline if entry[2] in self._seq]
+            self._by_request = [entry for entry in self._by_request if entry[2] in self._seq]
+            heapq.heapify(self._by_deadline)
+            heapq.heapify(self._by_request)
+
+
+    def __contains__(self, passenger):
+        return passenger in self._seq
+
+    def __iter__(self):
+        return iter(self._seq)
+
+    def __len__(self):
+        return len(self._seq)
+
+    def __bool__(self):
+        return bool(self._seq)
+
+    def __getitem__(self, index):
+        if index == 0 and self._seq:
+            return next(iter(self._seq))
+        return list(self._seq)[index]
+
+
+    def _peek(self, heap):
+        while heap and self._seq.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def most_urgent(self):
+        # passenger with the earliest latest_pickup_time, ties going to the earliest arrival
+        return self._peek(self._by_deadline)
+
+    def earliest(self):
+        # passenger with the earliest request_time, ties going to the earliest arrival
+        return self._peek(self._by_request)
+
+
+    def nearest(self, loc, distance=None):
+        # passenger whose src is closest (manhattan) to loc, ties going to the earliest arrival,
+        # i.e. the same choice as a linear scan over the clients list.
+        # distance(loc, src) replaces manhattan, e.g. on a road network, with a linear scan
+        if not self._seq:
+            return None
+        if distance is not None:
+            return min(self._seq.items(), key=lambda item: (distance(loc, item[0].src), item[1]))[0]
+
+        size = self.bucket_size
+        bx, by = loc.x // size, loc.y // size
+        best = None # (distance, seq, passenger)
+        ring = 0
+        while True:
+            # any cell in a bucket on this ring is at least this far away
+            if best is not None and best[0] < (ring - 1) * size + 1:
+                break
+
+            if (2 * ring + 1) ** 2 >= len(self._buckets):
+                # probed as many buckets as are occupied, scan what is left instead
+                keys = [key for key in self._buckets if max(abs(key[0] - bx), abs(key[1] - by)) >= ring]
+                best = self._closest_in(keys, loc, best)
+                break
+
+            best = self._closest_in(self._ring_keys(bx, by, ring), loc, best)
+            ring += 1
+
+        return best[2]
+
+
+    def in_rect(self, from_x, to_x, from_y, to_y):
+        # passengers whose src lies in from_x..to_x by from_y..to_y, from the buckets the rectangle touches
+        size = self.bucket_size
+        keys = [(i, j) for i in range(from_x // size, to_x // size + 1) for j in range(from_y // size, to_y // size + 1)]
+        if len(keys) > len(self._buckets):
+            keys = list(self._buckets)
+        found = []
+        for key in keys:
+            for passenger in self._buckets.get(key, ()):
+                if from_x <= passenger.src.x <= to_x and from_y <= passenger.src.y <= to_y:
+                    found.append(passenger)
+        return found
+
+
+    def _ring_keys(self, bx, by, ring):
+        if ring == 0:
+            return [(bx, by)]
+        keys = []
+        for i in range(bx - ring, bx + ring + 1):
+            keys.append((i, by - ring))
+            keys.append((i, by + ring))
+        for j in range(by - ring + 1, by + ring):
+            keys.append((bx - ring, j))
+            keys.append((bx + ring, j))
+        return keys
+
+
+    def _closest_in(self, keys, loc, best):
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                continue
+            for passenger, seq in bucket.items():
+                dist = abs(passenger.src.x - loc.x) + abs(passenger.src.y - loc.y)
+                if best is None or (dist, seq) < (best[0], best[1]):
+                    best = (dist, seq, passenger)
+        return best
@@ -0,0 +1,154 @@
+import random
+
+import numpy as np
+
+# one row per request, sorted by step; waiting_time -1 lets the model draw it as usual.
+# Rows with step -1 hold driver start positions in src_x, src_y.
+DEMAND_DTYPE = np.dtype([("step", "<i4"), ("src_x", "<i4"), ("src_y", "<i4"), ("dest_x", "<i4"), ("dest_y", "<i4"),
+                         ("waiting_time", "<i4"), ("sec_id", "<i8")])
+
+
+def draw_secondary_id(seed, num_range):
+    # same draw and range update as copying num_range into a list, removing the id and
+    # taking the range from the first to the last number left, without the copy
+    secondary_id = seed.choice(num_range)
+    if len(num_range) == 1:
+        return secondary_id, range(0)
+    if secondary_id == num_range[0]:
+        return secondary_id, range(num_range.start + 1, num_range.stop)
+    if secondary_id == num_range[-1]:
+        return secondary_id, range(num_range.start, num_range.stop - 1)
+    return secondary_id, num_range
+
+
+def rng_streams(seed_int, replication):
+    """Separate (demand, patience, activation) random.Random streams for replication of seed_int.
+
+    Each stream is seeded from its own child of np.random.SeedSequence([seed_int, replication]),
+    so what one part of the model draws never shifts what another sees: two strategies run on
+    the same seed and replication get identical requests and patience.
+    """
+    children = np.random.SeedSequence([seed_int, replication]).spawn(3)
+    return tuple(random.Random(int.from_bytes(child.generate_state(4).tobytes(), "little")) for child in children)
+
+
+class Demand:
+    """The requests of a run as columns, in arrival order, and optionally where the drivers start.
+
+    requests is a DEMAND_DTYPE array, which may be memory mapped from a file, so a model
+    handed a Demand only reads the rows of the current step and only creates a Passenger when
+    its step comes up. drivers is an array of (x, y) rows or None. The same Demand can be given
+    to any number of models, e.g. one per strategy, and each sees identical requests.
+    """
+
+    def __init__(self, requests, drivers=None):
+        self.requests = requests
+        self.drivers = drivers
+        self._steps = requests["step"]
+
+
+    def __len__(self):
+        return len(self.requests)
+
+    def rows(self, start, step):
+        # requests from row start whose step has come up by step, and the row to start from next time
+        stop = int(np.searchsorted(self._steps, step, side="right"))
+        return self.requests[start:stop], stop
+
+
+def generate_demand(num_drivers, size, seed_int, rate, steps, waiting_time=None, total_steps=0, iteration=0, replication=None):
+    """Pre-generate the requests TransportModel would make over steps steps, and the driver starts.
+
+    Pickup and drop off locations, secondary ids and driver starts are drawn from
+    random.Random(seed_int) in the model's own order, so they are the ones an inline run makes.
+    Waiting times come from a numpy rng seeded with (seed_int, iteration) instead of the
+    model's mesa rng, so they no longer depend on the activation order. With replication,
+    locations come from the demand stream of rng_streams, as in TransportModel(replication=...).
+    """
+    seed = random.Random(seed_int) if replication is None else rng_streams(seed_int, replication)[0]
+    rng = np.random.default_rng([seed_int, iteration])
+    num_range = range(1, total_steps//rate + num_drivers + 1) if total_steps else None
+
+    arrivals = [0] * num_drivers + list(range(rate, steps + 1, rate))
+    requests = np.zeros(len(arrivals), dtype=DEMAND_DTYPE)
+    requests["step"] = arrivals
+
+    def request(i):
+        nonlocal num_range
+        x, y = seed.randrange(size), seed.randrange(size)
+        secondary_id = 0
+        if total_steps:
+            secondary_id, num_range = draw_secondary_id(seed, num_range)
+        dest_x, dest_y = seed.randrange(size), seed.randrange(size)
+        while (dest_x, dest_y) == (x, y):
+            dest_x, dest_y = seed.randrange(size), seed.randrange(size)
+        requests[i] = (arrivals[i], x, y, dest_x, dest_y, 0, secondary_id)
+
+    # drivers are placed after the first passengers
+    for i in range(num_drivers):
+        request(i)
+    drivers = np.array([(seed.randrange(size), seed.randrange(size)) for _ in range(num_drivers)], dtype=np.int64).reshape(-1, 2)
+    for i in range(num_drivers, len(arrivals)):
+        request(i)
+
+    if waiting_time:
+        requests["waiting_time"] = rng.integers(waiting_time, waiting_time + 11, size=len(requests))
+    else:
+        requests["waiting_time"] = rng.integers(10, 41, size=len(requests))
+    return Demand(requests, drivers)
+
+
+def save_demand(path, demand):
+    # a single .npy file, driver starts first as rows with step -1
+    drivers = np.zeros(0 if demand.drivers is None else len(demand.drivers), dtype=DEMAND_DTYPE)
+    drivers["step"] = -1
+    if demand.drivers is not None:
+        drivers["src_x"], drivers["src_y"] = demand.drivers[:, 0], demand.drivers[:, 1]
+    np.save(path, np.concatenate([drivers, np.asarray(demand.requests, dtype=DEMAND_DTYPE)]))
+
+
+def load_demand(path, mmap=True):
+    # Demand from a file written by save_demand or demand_from_csv, memory mapped unless mmap is False
+    rows = np.load(path, mmap_mode="r" if mmap else None)
+    if rows.dtype != DEMAND_DTYPE:
+        raise ValueError(f"{path} does not hold demand rows")
+    num_drivers = int(np.searchsorted(rows["step"], 0))
+    drivers = None
+    if num_drivers:
+        drivers = np.stack([rows["src_x"][:num_drivers], rows["src_y"][:num_drivers]], axis=1).astype(np.int64)
+    return Demand(rows[num_drivers:], drivers)
+
+
+def demand_from_csv(csv_path, path, chunksize=100_000):
+    """Convert a trip log to a demand file, reading chunksize rows at a time.
+
+    The csv needs step, src_x, src_y, dest_x and dest_y columns, sorted by step, and may
+    have waiting_time and sec_id. The rows are written straight into a memory mapped .npy,
+    so logs larger than memory can be converted and then replayed with load_demand.
+    Zero length trips, with the same pickup and drop off cell, are left out.
+    """
+    import pandas as pd
+
+    def trips(chunk):
+        return (chunk["src_x"] != chunk["dest_x"]) | (chunk["src_y"] != chunk["dest_y"])
+
+    locations = ["src_x", "src_y", "dest_x", "dest_y"]
+    num_rows = sum(int(trips(chunk).sum()) for chunk in pd.read_csv(csv_path, usecols=locations, chunksize=chunksize))
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=DEMAND_DTYPE, shape=(num_rows,))
+    start = 0
+    last_step = -1
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        steps = chunk["step"].to_numpy()
+        if len(steps) and (steps[0] < last_step or (np.diff(steps) < 0).any()):
+            raise ValueError(f"{csv_path} is not sorted by step")
+        last_step = steps[-1] if len(steps) else last_step
+        chunk = chunk[trips(chunk)]
+        stop = start + len(chunk)
+        for name in DEMAND_DTYPE.names:
+            if name in chunk:
+                out[name][start:stop] = chunk[name].to_numpy()
+            else:
+                out[name][start:stop] = -1 if name == "waiting_time" else 0
+        start = stop
+    out.flush()
+    del out
@@ -0,0 +1,176 @@
+import heapq
+import mesa
+
+from Agents import Driver, Passenger, StepType
+
+
+class EventActivation(mesa.time.RandomActivation):
+    """RandomActivation that only wakes agents with something to do in the current step.
+
+    Passengers are woken when their latest pickup time runs out and, once dropped off,
+    until they leave the schedule. Drivers are woken when they reach the next waypoint in
+    current_routes, and while there are waiting clients: idle drivers in activation order
+    until the clients run out, and multi passenger drivers with a free seat whose route
+    leg model.route_index has handed a client (every such driver off manhattan roads). In
+    between, a driving car only follows model.roads to the next waypoint, so its position
+    and steps_taken are brought up to date in one go when it next wakes, as is the
+    idle_time of an idle driver; idle_pending counts the idle steps not yet added.
+
+    The activation order is still shuffled every step, so the model rng stays in lockstep
+    with RandomActivation and the run produces the same pickups, drop offs and abandonments.
+    The shuffle costs as much as in RandomActivation, and a model with agent_data syncs
+    every step, so it gains most with sparse demand, where most cars sleep most of the
+    time. Car positions and counters can lag behind while they sleep; call sync() before
+    reading them.
+    """
+
+    def __init__(self, model):
+        super().__init__(model)
+        self._due = [] # (step, seq, agent) wake ups
+        self._seq = 0
+        self._wake_at = {} # driver -> step of its live entry in _due
+        self._idle = {} # driver with no route -> first step not in its idle_time, asleep until there are clients
+        self._idle_since = 0 # sum of the steps in _idle
+        self._travel = {} # driver -> step at which its current position and steps_taken were last valid
+        self._sticky = set() # dropped off passengers, stepped until they leave the schedule
+        self._other = set() # agents that are neither drivers nor passengers, stepped every step
+
+
+    @property
+    def idle_pending(self):
+        # idle steps of sleeping drivers not in their idle_time yet, see kpis.utilisation
+        return len(self._idle) * self.steps - self._idle_since
+
+
+    def add(self, agent):
+        super().add(agent)
+        if isinstance(agent, Passenger):
+            self._wake(agent, agent.latest_pickup_time + 1)
+        elif isinstance(agent, Driver):
+            if agent.multi_pass and agent.current_routes:
+                # a car that sets off asleep is only woken for clients on its leg
+                self.model.route_index.register(agent, agent.current_routes[0][0])
+            self._settle(agent, self.steps)
+        else:
+            self._other.add(agent)
+
+    def remove(self, agent):
+        if isinstance(agent, Driver):
+            self._catch_up(agent, self.steps)
+        super().remove(agent)
+        self._sticky.discard(agent)
+        self._other.discard(agent)
+        self._travel.pop(agent, None)
+        self._wake_at.pop(agent, None)
+
+
+    def _wake(self, agent, step):
+        if isinstance(agent, Driver):
+            self._wake_at[agent] = step
+        heapq.heappush(self._due, (step, self._seq, agent))
+        self._seq += 1
+
+
+    def _settle(self, driver, step):
+        # decide how driver, up to date until step, sleeps from step onwards
+        self._travel.pop(driver, None)
+        self._wake_at.pop(driver, None)
+
+        if not driver.current_routes:
+            self._idle[driver] = step
+            self._idle_since += step
+            return
+        distance = self.model.roads.distance(driver.current, driver.current_routes[0][0])
+        if distance:
+            self._travel[driver] = step
+        self._wake(driver, step + distance)
+
+
+    def _catch_up(self, driver, step):
+        # what a sleeping driver did up to the start of step: idled, or drove along its route
+        since = self._idle.pop(driver, None)
+        if since is not None:
+            self._idle_since -= since
+            driver.idle_time += step - since
+        self._advance(driver, step)
+
+    def _advance(self, driver, step):
+        since = self._travel.get(driver)
+        if since is None or since == step:
+            return
+        self._travel[driver] = step
+
+        driver.steps_taken += step - since
+        x, y = self.model.roads.advance(driver.current, driver.current_routes[0][0], step - since)
+        driver.current.x, driver.current.y = x, y
+        self.model.grid.move_agent(driver, (x, y))
+
+
+    def sync(self):
+        # bring every sleeping car's position and counters up to date, e.g. before drawing the grid
+        for driver in list(self._travel):
+            self._advance(driver, self.steps)
+        for driver, since in self._idle.items():
+            driver.idle_time += self.steps - since
+            self._idle[driver] = self.steps
+        self._idle_since = len(self._idle) * self.steps
+
+
+    def step(self):
+        now = self.steps
+        model = self.model
+        clients = model.clients
+        agent_keys = self.get_agent_keys(shuffle=True)
+        order = dict(zip(agent_keys, range(len(agent_keys))))
+
+        awake = self._sticky | self._other
+        while self._due and self._due[0][0] <= now:
+            step, _, agent = heapq.heappop(self._due)
+            if not isinstance(agent, Driver) or self._wake_at.get(agent) == step:
+                awake.add(agent)
+
+        idle = []
+        if model.strategy == StepType.BATCH:
+            # idle drivers given a route by the model
+            awake.update(driver for driver in self._idle if driver.current_routes)
+        elif clients:
+            # each idle driver takes a client or drops the ones it can't reach, so only the
+            # first ones in activation order have anything to do
+            idle = [(order[driver.unique_id], driver) for driver in self._idle]
+            heapq.heapify(idle)
+        if clients:
+            # the rectangle ahead of a car on manhattan roads only shrinks, so it can only find a
+            # client route_index has handed it; elsewhere the car can turn towards new ones
+            drivers = model.route_index.active if model.roads.manhattan else self._travel
+            awake.update(driver for driver in drivers
+                         if driver in self._travel and driver.multi_pass and len(driver.passengers) < driver.max_passengers)
+
+        queue = [(order[agent.unique_id], agent) for agent in awake if agent.unique_id in order]
+        heapq.heapify(queue)
+        while True:
+            if idle and clients and (not queue or idle[0][0] < queue[0][0]):
+                position, agent = heapq.heappop(idle)
+            elif queue:
+                position, agent = heapq.heappop(queue)
+            else:
+                break
+            if self._agents.get(agent.unique_id) is not agent:
+                continue
+
+            if isinstance(agent, Driver):
+                self._catch_up(agent, now)
+                carried = list(agent.passengers)
+                agent.step()
+                for passenger in carried:
+                    if passenger not in agent.passengers:
+                        # dropped off, so its own clean up starts this step, if it is still to come
+                        self._sticky.add(passenger)
+                        if passenger not in awake and order.get(passenger.unique_id, -1) > position:
+                            awake.add(passenger)
+                            heapq.heappush(queue, (order[passenger.unique_id], passenger))
+                self._settle(agent, now + 1)
+            else:
+                agent.step()
+
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,184 @@
+import struct
+
+import mesa
+import numpy as np
+
+# event types
+DRIVER = 0 # driver placed at its start position
+REQUEST = 1 # passenger appears at its pickup location
+DESTINATION = 2 # where that passenger wants to go, recorded right after REQUEST
+PICKUP = 3 # other is the driver
+DROPOFF = 4 # other is the driver, position is the destination
+ABANDON = 5 # passenger left after waiting too long
+ARRIVAL = 6 # driver reached the next point on its route
+MOVE = 7 # driver moved one cell
+
+MAGIC = b"RSTRACE1"
+HEADER = struct.Struct("<8sHH") # magic, grid width, grid height
+RECORD = struct.Struct("<iBiiHH") # step, event type, agent id, other agent id (-1 if none), x, y
+RECORD_DTYPE = np.dtype([("step", "<i4"), ("event", "u1"), ("agent", "<i4"), ("other", "<i4"),
+                         ("x", "<u2"), ("y", "<u2")])
+
+
+class EventTrace:
+    """Appends fixed size binary event records to a buffered file.
+
+    The model only holds an EventTrace when tracing is switched on, and every call site
+    checks for it first, so a run without a trace does no work here at all.
+    """
+
+    def __init__(self, path, width, height, buffer_size=1 << 16):
+        self.path = path
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._file.write(HEADER.pack(MAGIC, width, height))
+        self._pack = RECORD.pack
+        self.closed = False
+
+
+    def emit(self, step, event, agent, other, x, y):
+        self._file.write(self._pack(step, event, agent, other, x, y))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+
+
+def read_header(path):
+    # (width, height) of the grid a trace was recorded on
+    with open(path, "rb") as f:
+        magic, width, height = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not an event trace")
+    return width, height
+
+
+def read_trace(path):
+    # all records in step order, as a numpy structured array with the fields of RECORD_DTYPE
+    read_header(path)
+    records = np.fromfile(path, dtype=RECORD_DTYPE, offset=HEADER.size)
+    return records[np.argsort(records["step"], kind="stable")]
+
+
+class TraceAgent(mesa.Agent):
+    """Stand in for a driver, passenger or destination marker while replaying a trace."""
+
+    def __init__(self, unique_id, model, agent_type):
+        super().__init__(unique_id, model)
+        self.type = agent_type
+
+
+class TraceReplay(mesa.Model):
+    """Plays a recorded event trace back on a grid, one model step per recorded step.
+
+    Can be served by transport_vis.py in place of TransportModel, without re-running the
+    simulation. Drivers whose moves were not recorded step by step (the event driven
+    schedule only records them when a car wakes) are walked towards their next recorded
+    position the same way cars drive: along x first, then y, one cell per step.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        width, height = read_header(path)
+        self.grid = mesa.space.MultiGrid(width, height, False)
+        self.running = True
+        self.steps = 0
+
+        # frame k shows the grid at the end of step k; passengers requested at the end of a step are
+        # recorded with the next step, their request_time, so they are shown one frame earlier
+        records = read_trace(path)
+        frames = np.maximum(records["step"] - np.isin(records["event"], (REQUEST, DESTINATION)), 0)
+        order = np.argsort(frames, kind="stable")
+        self.records, frames = records[order], frames[order]
+        self.last_step = int(frames.max(initial=0))
+        # index of the first record of every frame
+        self._bounds = np.searchsorted(frames, np.arange(self.last_step + 2))
+
+        self.drivers = {} # id -> TraceAgent
+        self.passengers = {} # id -> TraceAgent, while waiting
+        self.destinations = {} # passenger id -> (x, y)
+        self.dest_vis = {} # passenger id -> TraceAgent, while in a car
+        self._driver_records = self._positions_by_driver()
+        self._driver_index = {} # driver id -> first of its positions not yet passed
+        self.apply(0)
+        self._walk_unrecorded(0)
+
+
+    def _positions_by_driver(self):
+        # driver id -> [(step, x, y)] of its recorded positions, step being the one it held the position at the end of
+        records = self.records
+        mask = np.isin(records["event"], (DRIVER, ARRIVAL, MOVE))
+        positions = {}
+        for event, step, agent, x, y in zip(records["event"][mask], records["step"][mask], records["agent"][mask],
+                                            records["x"][mask], records["y"][mask]):
+            # start positions and arrivals are recorded at the start of a step, i.e. where the car was at the end of the last one
+            step = int(step) - 1 if event in (DRIVER, ARRIVAL) else int(step)
+            positions.setdefault(int(agent), []).append((step, int(x), int(y)))
+        return positions
+
+
+    def _place(self, agent, pos):
+        if agent.pos is None:
+            self.grid.place_agent(agent, pos)
+        else:
+            self.grid.move_agent(agent, pos)
+
+
+    def apply(self, step):
+        # replay the records of one step
+        start, stop = self._bounds[step], self._bounds[step + 1]
+        for record in self.records[start:stop]:
+            event, agent_id, pos = int(record["event"]), int(record["agent"]), (int(record["x"]), int(record["y"]))
+
+            if event == DRIVER:
+                self.drivers[agent_id] = TraceAgent(agent_id, self, "Driver")
+                self._place(self.drivers[agent_id], pos)
+            elif event in (ARRIVAL, MOVE):
+                self._place(self.drivers[agent_id], pos)
+            elif event == REQUEST:
+                self.passengers[agent_id] = TraceAgent(agent_id, self, "Passenger")
+                self._place(self.passengers[agent_id], pos)
+            elif event == DESTINATION:
+                self.destinations[agent_id] = pos
+            elif event == PICKUP:
+                self.grid.remove_agent(self.passengers.pop(agent_id))
+                self.dest_vis[agent_id] = TraceAgent(agent_id, self, "dest_vis")
+                self._place(self.dest_vis[agent_id], self.destinations[agent_id])
+            elif event == DROPOFF:
+                self.grid.remove_agent(self.dest_vis.pop(agent_id))
+                self.destinations.pop(agent_id, None)
+            elif event == ABANDON:
+                passenger = self.passengers.pop(agent_id, None)
+                if passenger is not None and passenger.pos is not None:
+                    self.grid.remove_agent(passenger)
+                self.destinations.pop(agent_id, None)
+
+
+    def _walk_unrecorded(self, step):
+        # move drivers with a gap before their next recorded position
+        for agent_id, driver in self.drivers.items():
+            positions = self._driver_records[agent_id]
+            i = self._driver_index.get(agent_id, 0)
+            while i < len(positions) and positions[i][0] < step:
+                i += 1
+            self._driver_index[agent_id] = i
+            if i == len(positions):
+                continue
+            next_step, x, y = positions[i]
+            cx, cy = driver.pos
+            if abs(x - cx) + abs(y - cy) <= next_step - step:
+                continue # still idle, or waiting before it sets off
+            if cx != x:
+                cx += 1 if x > cx else -1
+            elif cy != y:
+                cy += 1 if y > cy else -1
+            self.grid.move_agent(driver, (cx, cy))
+
+
+    def step(self):
+        self.steps += 1
+        if self.steps > self.last_step:
+            self.running = False
+            return
+        self._walk_unrecorded(self.steps)
+        self.apply(self.steps)
@@ -0,0 +1,53 @@
+class SparseGrid:
+    """Grid that only stores occupied cells, for maps too large to allocate cell by cell.
+
+    Keeps MultiGrid's semantics for what the model uses: place_agent, move_agent and
+    remove_agent set agent.pos, a cell holds agents in the order they were placed, and
+    get_cell_list_contents takes a cell or a list of cells. Not toroidal.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.torus = False
+        self._cells = {} # (x, y) -> [agents], occupied cells only
+
+
+    def out_of_bounds(self, pos):
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+
+    def place_agent(self, agent, pos):
+        cell = self._cells.setdefault(pos, [])
+        if agent.pos is None or agent not in cell:
+            cell.append(agent)
+            agent.pos = pos
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        cell = self._cells[pos]
+        cell.remove(agent)
+        if not cell:
+            del self._cells[pos]
+        agent.pos = None
+
+    def move_agent(self, agent, pos):
+        if self.out_of_bounds(pos):
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        self.remove_agent(agent)
+        self.place_agent(agent, pos)
+
+
+    def is_cell_empty(self, pos):
+        return pos not in self._cells
+
+    def iter_cell_list_contents(self, cell_list):
+        if isinstance(cell_list, tuple) and len(cell_list) == 2:
+            cell_list = [cell_list]
+        for pos in cell_list:
+            yield from self._cells.get(pos, ())
+
+    def get_cell_list_contents(self, cell_list):
+        return list(self.iter_cell_list_contents(cell_list))
+
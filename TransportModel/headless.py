@@ -0,0 +1,124 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+try:
+    import tomllib
+except ImportError: # python < 3.11, only JSON scenarios
+    tomllib = None
+
+from Agents import StepType
+from TransportModel import seeded_model
+from checkpoint import report
+
+# scenario section -> {key: TransportModel argument}
+SECTIONS = {
+    "fleet": {"num_drivers": "num_drivers", "multi_pass": "multi_pass"},
+    "grid": {"size": "size", "sparse": "sparse_grid", "road_network": "road_network"},
+    "demand": {"seed": "seed_int", "rate": "rate", "waiting_time": "waiting_time", "total_steps": "total_steps", "file": "demand"},
+    "schedule": {"event_driven": "event_driven", "two_phase": "two_phase", "workers": "workers", "steady_state": "steady_state"},
+}
+
+DEFAULTS = {"num_drivers": 5, "multi_pass": False, "size": 10, "seed_int": 125, "waiting_time": None, "rate": 5}
+
+
+def load_scenario(path):
+    """Scenario from a JSON or TOML file, e.g.
+
+        name = "city"
+        strategy = "CLOSEST"
+        steps = 1440
+        [fleet]    num_drivers, multi_pass
+        [grid]     size, sparse, road_network
+        [demand]   seed, rate, waiting_time, total_steps, file (a demand.save_demand file)
+        [schedule] event_driven, two_phase, workers, steady_state
+        [output]   trips, series
+
+    Relative file names are taken relative to the scenario file. Returns a dict with
+    name, steps, output and params, the TransportModel arguments.
+    """
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ImportError("TOML scenarios need python 3.11")
+        with open(path, "rb") as f:
+            scenario = tomllib.load(f)
+    else:
+        with open(path) as f:
+            scenario = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(path))
+    params = dict(DEFAULTS)
+    for section, keys in SECTIONS.items():
+        for key, value in scenario.get(section, {}).items():
+            if key not in keys:
+                raise ValueError(f"{path}: unknown key {key!r} in [{section}]")
+            if key in ("file", "road_network"):
+                value = os.path.join(base, value)
+            params[keys[key]] = value
+    unknown = set(scenario) - set(SECTIONS) - {"name", "strategy", "steps", "output"}
+    if unknown:
+        raise ValueError(f"{path}: unknown keys {sorted(unknown)}")
+
+    strategy = scenario.get("strategy", "CLOSEST")
+    params["strategy"] = StepType[strategy.upper()] if isinstance(strategy, str) else StepType(strategy)
+    name = scenario.get("name", os.path.splitext(os.path.basename(path))[0])
+    return {"name": name, "steps": scenario.get("steps", 1440), "output": scenario.get("output", {}), "params": params}
+
+
+def run_scenario(scenario, out_dir):
+    """Run a scenario with nothing but the model, and write out_dir/<name>.json.
+
+    The file holds the parameters, the end of run KPIs and the throughput: steps/sec, wall
+    time and the peak resident memory of the whole process, so the command line runs every
+    scenario in a process of its own. With output.trips the trip records are
+    written to <name>.npz, with output.series the per step KPIs to <name>_series.csv.
+    """
+    name, steps, output, params = scenario["name"], scenario["steps"], scenario["output"], scenario["params"]
+    trip_file = os.path.join(out_dir, name + ".npz") if output.get("trips") else None
+
+    start = time.perf_counter()
+    model = seeded_model(params["seed_int"], **params, trip_file=trip_file, agent_data=False, show_destinations=False)
+    setup = time.perf_counter() - start
+    while model.running and model.schedule.steps < steps:
+        model.step()
+    model.finish()
+    wall = time.perf_counter() - start
+
+    summary = {
+        "name": name,
+        "params": {key: value.name if isinstance(value, StepType) else value for key, value in params.items()},
+        "kpis": report(model),
+        "throughput": {
+            "steps": model.schedule.steps,
+            "wall_s": wall,
+            "setup_s": setup,
+            "steps_per_sec": model.schedule.steps / (wall - setup) if wall > setup else None,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+    }
+    if output.get("series"):
+        model.datacollector.get_model_vars_dataframe().to_csv(os.path.join(out_dir, name + "_series.csv"), index_label="Step")
+    with open(os.path.join(out_dir, name + ".json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run ridesharing scenarios headless, without the visualisation server')
+
+    parser.add_argument('scenarios', nargs='+', help='JSON or TOML scenario files')
+    parser.add_argument('--out', type=str, default='results', help='Directory for the result files')
+
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    for path in args.scenarios:
+        # a fresh process per scenario, so its peak RSS isn't that of an earlier, larger one
+        with multiprocessing.Pool(1) as pool:
+            summary = pool.apply(run_scenario, (load_scenario(path), args.out))
+        throughput = summary["throughput"]
+        print(f"{summary['name']}: {throughput['steps']} steps in {throughput['wall_s']:.2f}s, "
+              f"{throughput['steps_per_sec']:.1f} steps/s, peak RSS {throughput['peak_rss_mib']:.0f} MiB")
@@ -0,0 +1,138 @@
+import math
+
+
+class RunningStat:
+    """Count, mean and variance of a stream of whole numbers (Welford), plus an exact
+    histogram with one bin per value for percentiles.
+
+    Values in this model are step counts bounded by the run length, so the histogram
+    stays small and percentiles match the ones computed from per agent dumps.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        self._bins = {} # value -> count
+
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self._bins[value] = self._bins.get(value, 0) + 1
+
+
+    @property
+    def variance(self):
+        # sample variance, as pandas .var()
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+    def percentile(self, q):
+        # nearest rank percentile, q in [0, 100]; None while empty
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for value in sorted(self._bins):
+            seen += self._bins[value]
+            if seen >= rank:
+                return value
+
+
+    def merge(self, other):
+        # combine with the stats of another run or region
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for value, n in other._bins.items():
+            self._bins[value] = self._bins.get(value, 0) + n
+
+
+class KPITracker:
+    """Run KPIs kept up to date from passenger events instead of per step agent dumps.
+
+    Follows the definitions used in the analysis notebooks: waiting and detour times are
+    over passengers that were dropped off, the fulfilment rate is dropped off passengers
+    over all requests, and utilisation is the share of steps drivers were not idle.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.pickups = 0
+        self.dropoffs = 0
+        self.abandoned = 0
+        self.wait = RunningStat() # pickup_time - request_time
+        self.detour = RunningStat() # time in the car beyond the shortest distance
+
+
+    def on_request(self, passenger):
+        self.requests += 1
+
+    def on_pickup(self, passenger):
+        self.pickups += 1
+
+    def on_dropoff(self, passenger):
+        self.dropoffs += 1
+        self.wait.add(passenger.pickup_time - passenger.request_time)
+        self.detour.add(passenger.dropoff_time - passenger.pickup_time - passenger.shortest_distance)
+
+    def on_abandon(self, passenger):
+        self.abandoned += 1
+
+
+    def fulfilment_rate(self):
+        # percentage of requests that were dropped off
+        return 100 * self.dropoffs / self.requests if self.requests else None
+
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.pickups += other.pickups
+        self.dropoffs += other.dropoffs
+        self.abandoned += other.abandoned
+        self.wait.merge(other.wait)
+        self.detour.merge(other.detour)
+
+
+def utilisation(drivers, steps, pending=0):
+    # average percentage of steps the drivers spent doing something other than idling;
+    # pending idle steps are not in idle_time yet, e.g. of drivers asleep in event_schedule.EventActivation
+    if not drivers or not steps:
+        return None
+    idle = (sum(driver.idle_time for driver in drivers) + pending) / len(drivers)
+    return 100 - 100 * idle / steps
+
+
+# DataCollector model reporters for a model with a .kpis KPITracker and a .drivers list
+KPI_REPORTERS = {
+    "Requests": lambda m: m.kpis.requests,
+    "PickedUp": lambda m: m.kpis.pickups,
+    "DroppedOff": lambda m: m.kpis.dropoffs,
+    "Abandoned": lambda m: m.kpis.abandoned,
+    "FulfilmentRate": lambda m: m.kpis.fulfilment_rate(),
+    "MeanWait": lambda m: m.kpis.wait.mean if m.kpis.wait.count else None,
+    "StdWait": lambda m: m.kpis.wait.std if m.kpis.wait.count else None,
+    "WaitP50": lambda m: m.kpis.wait.percentile(50),
+    "WaitP95": lambda m: m.kpis.wait.percentile(95),
+    "MeanDetour": lambda m: m.kpis.detour.mean if m.kpis.detour.count else None,
+    "StdDetour": lambda m: m.kpis.detour.std if m.kpis.detour.count else None,
+    "DetourP95": lambda m: m.kpis.detour.percentile(95),
+    "Utilisation": lambda m: utilisation(m.drivers, m.schedule.steps, getattr(m.schedule, "idle_pending", 0)),
+}
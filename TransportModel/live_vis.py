@@ -0,0 +1,247 @@
+import asyncio
+import json
+import multiprocessing
+import time
+
+import tornado.web
+import tornado.websocket
+
+from TransportModel import TransportModel
+from checkpoint import report
+from event_schedule import EventActivation
+
+# kind of a drawn agent, sent with every added agent
+IDLE_DRIVER, BUSY_DRIVER, WAITING = 0, 1, 2
+
+
+def snapshot(model):
+    # id -> (kind, x, y) of every car and every passenger waiting on the grid
+    if isinstance(model.schedule, EventActivation):
+        model.schedule.sync()
+    frame = {driver.unique_id: (BUSY_DRIVER if driver.passengers else IDLE_DRIVER, driver.current.x, driver.current.y)
+             for driver in model.drivers}
+    for agent in model.schedule.agents:
+        if agent.type == "Passenger" and agent.pos is not None:
+            frame[agent.unique_id] = (WAITING, agent.pos[0], agent.pos[1])
+    return frame
+
+
+def delta(old, new):
+    """Changes from frame old to frame new, as flat lists.
+
+    added is [id, kind, x, y, ...] for new agents and cars whose kind changed, moved is
+    [id, x, y, ...] for the rest that changed cell, removed is [id, ...].
+    """
+    added, moved = [], []
+    for agent_id, (kind, x, y) in new.items():
+        previous = old.get(agent_id)
+        if previous is None or previous[0] != kind:
+            added += (agent_id, kind, x, y)
+        elif previous[1] != x or previous[2] != y:
+            moved += (agent_id, x, y)
+    removed = [agent_id for agent_id in old if agent_id not in new]
+    return added, moved, removed
+
+
+def _simulate(conn, params, steps, fps, max_sps):
+    # model process: step flat out (or at most max_sps steps/sec) and send a delta at most fps times a second
+    model = TransportModel(**params, show_destinations=False, agent_data=False)
+    cells = getattr(model.roads, "cells", None)
+    conn.send({"size": model.grid.width, "roads": [] if cells is None else cells.ravel().tolist()})
+
+    frame = {}
+    interval = 1 / fps
+    start = next_frame = time.perf_counter()
+    while True:
+        done = not model.running or (steps and model.schedule.steps >= steps)
+        if not done:
+            model.step()
+            if max_sps:
+                time.sleep(max(0.0, start + model.schedule.steps / max_sps - time.perf_counter()))
+        now = time.perf_counter()
+        if now >= next_frame or done:
+            new = snapshot(model)
+            added, moved, removed = delta(frame, new)
+            frame = new
+            conn.send({"step": model.schedule.steps, "sps": model.schedule.steps / (now - start),
+                       "kpis": report(model), "added": added, "moved": moved, "removed": removed, "done": bool(done)})
+            next_frame = max(next_frame + interval, now)
+        if done:
+            break
+    model.finish()
+    conn.close()
+
+
+class LiveView:
+    """Frames from the model process, kept whole for clients that join or fall behind."""
+
+    def __init__(self):
+        self.init = None
+        self.state = {} # id -> [kind, x, y]
+        self.last = {}
+        self.sockets = set()
+
+    def receive(self, message):
+        if self.init is None:
+            self.init = message
+            return
+        added, moved = message["added"], message["moved"]
+        for i in range(0, len(added), 4):
+            self.state[added[i]] = added[i+1:i+4]
+        for i in range(0, len(moved), 3):
+            self.state[moved[i]][1:] = moved[i+1:i+3]
+        for agent_id in message["removed"]:
+            del self.state[agent_id]
+        self.last = {key: message[key] for key in ("step", "sps", "kpis", "done")}
+
+        text = json.dumps(message)
+        for socket in list(self.sockets):
+            socket.send_frame(text)
+
+    def full_frame(self):
+        # every agent as added, after clearing the client's drawing; None until the first frame has arrived
+        if not self.last:
+            return None
+        added = [value for agent_id, state in self.state.items() for value in (agent_id, *state)]
+        return json.dumps({**self.last, "reset": True, "added": added, "moved": [], "removed": []})
+
+
+class FrameSocket(tornado.websocket.WebSocketHandler):
+    def initialize(self, view):
+        self.view = view
+        self.sending = None
+        self.behind = False
+
+    def open(self):
+        self.view.sockets.add(self)
+        self.write_message(json.dumps(self.view.init))
+        frame = self.view.full_frame()
+        if frame is not None:
+            self.sending = self.write_message(frame)
+
+    def on_close(self):
+        self.view.sockets.discard(self)
+
+    def send_frame(self, text):
+        # a browser still busy with the last frame skips deltas and gets the whole frame once it catches up
+        if self.sending is not None and not self.sending.done():
+            self.behind = True
+            return
+        if self.behind:
+            self.behind = False
+            text = self.view.full_frame()
+        try:
+            self.sending = self.write_message(text)
+        except tornado.websocket.WebSocketClosedError:
+            self.view.sockets.discard(self)
+
+
+class PageHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(PAGE)
+
+
+async def _serve(conn, port):
+    view = LiveView()
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def read():
+        try:
+            view.receive(conn.recv())
+        except EOFError:
+            loop.remove_reader(conn.fileno())
+            finished.set_result(None)
+
+    # listen only once the first message, the map size, is in, as building the model can take a
+    # while for a road network or a large sparse grid
+    view.receive(await loop.run_in_executor(None, conn.recv))
+    app = tornado.web.Application([(r"/", PageHandler), (r"/ws", FrameSocket, {"view": view})])
+    app.listen(port)
+    print(f"Interface starting at http://127.0.0.1:{port}")
+    loop.add_reader(conn.fileno(), read)
+    await finished
+    # keep showing the last frame
+    await asyncio.Event().wait()
+
+
+def serve(params, steps=0, fps=10, port=8523, max_sps=0):
+    """Run TransportModel(**params) in its own process and stream it to the browser.
+
+    The model steps as fast as it can, or at most max_sps steps/sec, until steps or until it
+    stops running. At most fps times a second it sends the server what changed on the grid
+    since its last frame, cars moved and passengers added or removed, and the server passes
+    that on over a websocket. How fast the model steps is independent of how often and how
+    slowly the grid is drawn.
+    """
+    recv, send = multiprocessing.Pipe(duplex=False)
+    model_process = multiprocessing.Process(target=_simulate, args=(send, params, steps, fps, max_sps), daemon=True)
+    model_process.start()
+    send.close()
+    try:
+        asyncio.run(_serve(recv, port))
+    except KeyboardInterrupt:
+        pass
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Transport Model (live)</title></head>
+<body style="font-family: sans-serif">
+<canvas id="grid" width="700" height="700" style="border: 1px solid #ccc"></canvas>
+<pre id="stats"></pre>
+<script>
+const COLOURS = ["#1f77b4", "#d62728", "#2ca02c"]; // idle car, car with passengers, waiting passenger
+const canvas = document.getElementById("grid"), ctx = canvas.getContext("2d");
+const background = document.createElement("canvas");
+const agents = new Map();
+let size = 1, cell = 1, dirty = false, stats = "";
+
+function drawRoads(roads) {
+    background.width = canvas.width; background.height = canvas.height;
+    const bg = background.getContext("2d");
+    bg.fillStyle = "#eee";
+    for (let i = 0; i < roads.length; i += 2) bg.fillRect(roads[i] * cell, (size - 1 - roads[i+1]) * cell, cell, cell);
+}
+
+function apply(frame) {
+    if (frame.reset) agents.clear();
+    const added = frame.added, moved = frame.moved;
+    for (let i = 0; i < added.length; i += 4) agents.set(added[i], [added[i+1], added[i+2], added[i+3]]);
+    for (let i = 0; i < moved.length; i += 3) { const a = agents.get(moved[i]); a[1] = moved[i+1]; a[2] = moved[i+2]; }
+    for (const id of frame.removed) agents.delete(id);
+    stats = `step ${frame.step}${frame.done ? " (finished)" : ""}, ${frame.sps.toFixed(1)} steps/s\\n` +
+        Object.entries(frame.kpis).map(([k, v]) => `${k}: ${typeof v === "number" ? +v.toFixed(2) : v}`).join("\\n");
+    dirty = true;
+}
+
+function draw() {
+    if (dirty) {
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        ctx.drawImage(background, 0, 0);
+        const r = Math.max(cell, 1);
+        for (let kind = 0; kind < COLOURS.length; kind++) {
+            ctx.fillStyle = COLOURS[kind];
+            for (const [k, x, y] of agents.values()) if (k === kind) ctx.fillRect(x * cell, (size - 1 - y) * cell, r, r);
+        }
+        document.getElementById("stats").textContent = stats;
+        dirty = false;
+    }
+    requestAnimationFrame(draw);
+}
+
+const ws = new WebSocket(`ws://${location.host}/ws`);
+ws.onmessage = event => {
+    const message = JSON.parse(event.data);
+    if (message.size !== undefined) {
+        size = message.size; cell = canvas.width / size;
+        drawRoads(message.roads);
+    } else {
+        apply(message);
+    }
+};
+requestAnimationFrame(draw);
+</script>
+</body>
+</html>
+"""
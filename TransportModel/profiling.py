@@ -0,0 +1,110 @@
+import cProfile
+import functools
+import time
+
+
+class PhaseProfiler:
+    """Wall time and call counts per phase of TransportModel.step, plus per step gauges.
+
+    attach() swaps the phase methods of the model, its schedule and its agents for timed
+    wrappers on those instances only, so a model without a profiler runs untouched code.
+    Phases nest: move includes the get_passengers calls made while moving, and schedule
+    covers everything the agents do in a step.
+
+    With window=(start, stop), the steps from start up to stop are also run under cProfile;
+    the stats are kept in .cprofile and written to path if given.
+    """
+
+    PHASES = ("collect", "dispatch", "schedule", "move", "get_passengers", "pickup", "dropoff", "expiry")
+
+    def __init__(self, window=None, path=None):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.gauges = {"clients": [], "waiting": [], "route_mean": [], "route_max": []} # one entry per step
+        self.window = window
+        self.path = path
+        self.cprofile = None
+
+
+    def timed(self, phase, method):
+        seconds, calls = self.seconds, self.calls
+        clock = time.perf_counter
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds[phase] += clock() - start
+                calls[phase] += 1
+        return wrapper
+
+
+    def attach(self, model):
+        self.model = model
+        model.datacollector.collect = self.timed("collect", model.datacollector.collect)
+        model.assign_batch = self.timed("dispatch", model.assign_batch)
+        if hasattr(model.schedule, "dispatch"):
+            model.schedule.dispatch = self.timed("dispatch", model.schedule.dispatch)
+        schedule_step = self.timed("schedule", model.schedule.step)
+
+        def step():
+            self._profile_window()
+            schedule_step()
+            self._sample()
+        model.schedule.step = step
+
+        for driver in model.drivers:
+            self.attach_driver(driver)
+        for agent in model.schedule.agents:
+            if agent.type == "Passenger":
+                self.attach_passenger(agent)
+
+
+    def attach_driver(self, driver):
+        driver.set_next_dest = self.timed("dispatch", driver.set_next_dest)
+        driver.move = self.timed("move", driver.move)
+        driver.get_passengers = self.timed("get_passengers", driver.get_passengers)
+        driver.pickup_passenger = self.timed("pickup", driver.pickup_passenger)
+        driver.drop_off_passengers = self.timed("dropoff", driver.drop_off_passengers)
+
+    def attach_passenger(self, passenger):
+        passenger.step = self.timed("expiry", passenger.step)
+
+
+    def _sample(self):
+        model = self.model
+        routes = [len(driver.current_routes) for driver in model.drivers]
+        self.gauges["clients"].append(len(model.clients))
+        # requested but not yet picked up, including passengers no car can reach in time
+        self.gauges["waiting"].append(model.kpis.requests - model.kpis.pickups - model.kpis.abandoned)
+        self.gauges["route_mean"].append(sum(routes) / len(routes) if routes else 0)
+        self.gauges["route_max"].append(max(routes, default=0))
+
+
+    def _profile_window(self):
+        if not self.window:
+            return
+        steps = self.model.schedule.steps
+        if steps == self.window[0]:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif steps == self.window[1]:
+            self.stop()
+
+    def stop(self):
+        # end the cProfile window early, e.g. when the run finishes inside it
+        if self.cprofile is not None and self.window:
+            self.cprofile.disable()
+            self.window = None
+            if self.path:
+                self.cprofile.dump_stats(self.path)
+
+
+    def report(self):
+        # phase -> seconds and calls, and per gauge its mean and max over the run
+        report = {phase: {"seconds": self.seconds[phase], "calls": self.calls[phase]} for phase in self.PHASES}
+        for name, values in self.gauges.items():
+            report[name] = {"mean": sum(values) / len(values) if values else None, "max": max(values, default=None)}
+        return report
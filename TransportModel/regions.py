@@ -0,0 +1,332 @@
+import argparse
+import multiprocessing
+import time
+from types import SimpleNamespace
+
+import mesa
+import numpy as np
+
+from TransportModel import TransportModel
+from Agents import Driver, Passenger, StepType
+from demand import Demand, generate_demand
+from kpis import KPITracker, KPI_REPORTERS
+
+ID_STRIDE = 10**9 # agent ids of region r start at r * ID_STRIDE, so they stay unique across regions
+
+
+def region_of(x, y, size, regions_x, regions_y):
+    return (y * regions_y // size) * regions_x + x * regions_x // size
+
+
+def region_bounds(size, regions_x, regions_y):
+    # (from_x, to_x, from_y, to_y) of every region, inclusive, numbered as region_of does
+    xs = [(i * size + regions_x - 1) // regions_x for i in range(regions_x + 1)]
+    ys = [(j * size + regions_y - 1) // regions_y for j in range(regions_y + 1)]
+    return [(xs[i], xs[i+1] - 1, ys[j], ys[j+1] - 1) for j in range(regions_y) for i in range(regions_x)]
+
+
+class RegionModel(TransportModel):
+    """TransportModel for one region of a partitioned run.
+
+    It is handed only the requests and driver starts of its region, but keeps global
+    coordinates on a sparse grid of the whole map. Cars that drive out of the region are
+    taken out by export_driver between steps, with the passengers on their route, and
+    added to the region they entered by import_driver. Waiting clients near an edge shared
+    with another region are offered by claim_offers, and handed over with release_client
+    and import_client when a car across the edge is nearer. Regions always use the two
+    phase step: with RandomActivation every region shuffles its cars with its own rng, and
+    the KPIs drift well away from those of a single process run.
+    """
+
+    def __init__(self, region, bounds, **params):
+        self.region = region
+        self.bounds = bounds
+        super().__init__(**params, sparse_grid=True, show_destinations=False, agent_data=False, two_phase=True)
+
+    def next_id(self):
+        return self.region * ID_STRIDE + super().next_id()
+
+    def contains(self, loc):
+        from_x, to_x, from_y, to_y = self.bounds
+        return from_x <= loc.x <= to_x and from_y <= loc.y <= to_y
+
+    def near_edge(self, loc, band):
+        # within band cells of an edge shared with another region
+        from_x, to_x, from_y, to_y = self.bounds
+        last = self.grid.width - 1
+        return ((from_x > 0 and loc.x - from_x < band) or (to_x < last and to_x - loc.x < band)
+                or (from_y > 0 and loc.y - from_y < band) or (to_y < last and to_y - loc.y < band))
+
+    def claim_offers(self, band):
+        """Clients and idle cars within band cells of another region, for match_claims.
+
+        Returns ([(passenger state, manhattan distance to this region's nearest idle car)],
+        [(unique_id, x, y) of idle cars]).
+        """
+        idle = [driver for driver in self.drivers if not driver.current_routes]
+        clients = []
+        for passenger in self.clients:
+            src = passenger.src
+            if self.near_edge(src, band):
+                nearest = min((abs(driver.current.x - src.x) + abs(driver.current.y - src.y) for driver in idle), default=float("inf"))
+                clients.append((_passenger_state(passenger), nearest))
+        cars = [(driver.unique_id, driver.current.x, driver.current.y) for driver in idle if self.near_edge(driver.current, band)]
+        return clients, cars
+
+
+def _passenger_state(passenger):
+    return {name: getattr(passenger, name) for name in Passenger.__slots__ if name != "model"}
+
+
+def _import_passenger(model, state):
+    passenger = Passenger.__new__(Passenger)
+    mesa.Agent.__init__(passenger, state["unique_id"], model)
+    for name, value in state.items():
+        setattr(passenger, name, value)
+    position, passenger.pos = passenger.pos, None
+    model.schedule.add(passenger)
+    if position is not None:
+        model.grid.place_agent(passenger, position)
+    return passenger
+
+
+def release_client(model, passenger):
+    # take a waiting passenger out of model, claimed by another region
+    model.clients.remove(passenger)
+    model.schedule.remove(passenger)
+    model.grid.remove_agent(passenger)
+
+
+def import_client(model, state):
+    # add a waiting passenger claimed from another region, dispatched like the region's own clients
+    passenger = _import_passenger(model, state)
+    model.clients.append(passenger)
+    model.route_index.add(passenger)
+
+
+def export_driver(model, driver):
+    """Take driver out of model, with every passenger it carries or is on its way to.
+
+    Returns plain state for import_driver; passengers on the route are referred to by unique_id.
+    """
+    carried = {passenger.unique_id: passenger for passenger in driver.passengers}
+    carried.update((passenger.unique_id, passenger) for _, passenger in driver.current_routes)
+    passengers = []
+    for passenger in carried.values():
+        passengers.append(_passenger_state(passenger))
+        if passenger.unique_id in model.schedule._agents:
+            model.schedule.remove(passenger)
+        if passenger.pos is not None:
+            model.grid.remove_agent(passenger)
+
+    state = {name: getattr(driver, name) for name in Driver.__slots__ if name not in ("model", "pos", "_timing")}
+    state["current_routes"] = [(loc, passenger.unique_id) for loc, passenger in driver.current_routes]
+    state["passengers"] = [passenger.unique_id for passenger in driver.passengers]
+    model.route_index.unregister(driver)
+    model.schedule.remove(driver)
+    model.grid.remove_agent(driver)
+    model.drivers.remove(driver)
+    return state, passengers
+
+
+def import_driver(model, exported):
+    # add a driver taken out of another region by export_driver, with its passengers
+    state, passengers = exported
+    by_id = {}
+    for passenger_state in passengers:
+        passenger = _import_passenger(model, passenger_state)
+        by_id[passenger.unique_id] = passenger
+
+    driver = Driver.__new__(Driver)
+    mesa.Agent.__init__(driver, state["unique_id"], model)
+    for name, value in state.items():
+        setattr(driver, name, value)
+    driver._timing = None
+    driver.current_routes = [(loc, by_id[passenger_id]) for loc, passenger_id in state["current_routes"]]
+    driver.passengers = [by_id[passenger_id] for passenger_id in state["passengers"]]
+    model.schedule.add(driver)
+    model.grid.place_agent(driver, (driver.current.x, driver.current.y))
+    model.drivers.append(driver)
+
+
+def _region_worker(conn, region, bounds, seed, params, demand, band):
+    # one region, stepped once per message until None arrives, then its KPIs are sent back
+    model = RegionModel.__new__(RegionModel, seed=seed)
+    model.__init__(region, bounds, demand=demand, **params)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        incoming, released, claimed = message
+        for exported in incoming:
+            import_driver(model, exported)
+        for passenger_id in released:
+            release_client(model, model.schedule._agents[passenger_id])
+        for state in claimed:
+            import_client(model, state)
+        model.step()
+        leaving = [driver for driver in model.drivers if not model.contains(driver.current)]
+        exported = [export_driver(model, driver) for driver in leaving]
+        conn.send((exported, model.claim_offers(band) if band else ([], [])))
+    model.finish()
+    conn.send((model.kpis, [driver.idle_time for driver in model.drivers]))
+    conn.close()
+
+
+def match_claims(offers, steps):
+    """Hand offered clients to the region of a nearer idle car across the edge.
+
+    offers holds every region's claim_offers. A client goes to the region of the nearest
+    idle car of another region, by manhattan distance, if that car is nearer than every
+    idle car of its own region and can still reach it in time; each car is matched to one
+    client at most. The region then dispatches it like its own clients, so its cars may
+    still pick another one. Returns (released, claimed) per region: the unique_ids each
+    region gives away and the passenger states it takes in.
+    """
+    cars = [(region, unique_id, x, y) for region, (_, region_cars) in enumerate(offers) for unique_id, x, y in region_cars]
+    clients = sorted(((state, nearest, region) for region, (region_clients, _) in enumerate(offers) for state, nearest in region_clients),
+                     key=lambda item: item[0]["unique_id"])
+    released = [[] for _ in offers]
+    claimed = [[] for _ in offers]
+    taken = set()
+    for state, nearest, region in clients:
+        src = state["src"]
+        best = None
+        for other, unique_id, x, y in cars:
+            if other == region or unique_id in taken:
+                continue
+            distance = abs(x - src.x) + abs(y - src.y)
+            if distance < nearest and steps + distance <= state["latest_pickup_time"] and (best is None or distance < best[0]):
+                best = (distance, other, unique_id)
+        if best is not None:
+            taken.add(best[2])
+            released[region].append(state["unique_id"])
+            claimed[best[1]].append(state)
+    return released, claimed
+
+
+class MergedRun:
+    """KPIs merged over the regions of a run, with the attributes KPI_REPORTERS read from a model."""
+
+    def __init__(self, kpis, idle_times, steps):
+        self.kpis = kpis
+        self.drivers = [SimpleNamespace(idle_time=idle_time) for idle_time in idle_times]
+        self.schedule = SimpleNamespace(steps=steps)
+
+    def report(self):
+        return {name: reporter(self) for name, reporter in KPI_REPORTERS.items()}
+
+
+def split_demand(demand, size, regions_x, regions_y):
+    # requests by the region of their pickup, driver starts by the region they start in
+    requests = demand.requests
+    request_region = region_of(requests["src_x"], requests["src_y"], size, regions_x, regions_y)
+    driver_region = region_of(demand.drivers[:, 0], demand.drivers[:, 1], size, regions_x, regions_y)
+    return [Demand(np.ascontiguousarray(requests[request_region == r]), demand.drivers[driver_region == r])
+            for r in range(regions_x * regions_y)]
+
+
+def run_partitioned(num_drivers, size, multi_pass, seed_int, strategy, waiting_time, rate, steps,
+                    regions=(2, 1), demand=None, total_steps=0, claim_band=10, **model_params):
+    """Run the model split into regions_x by regions_y regions, one worker process each.
+
+    The requests and driver starts come from demand, generated from seed_int if not
+    given, so a single TransportModel(demand=demand) sees the same ones. Workers step in
+    lockstep; after every step each sends back the cars that left its region, and the
+    coordinator hands them to the region they are in before the next step. Each also
+    offers the clients and idle cars within claim_band cells of another region, and
+    match_claims moves a client to the region of a nearer idle car across the edge (0
+    turns this off). En route pickups stay within a region. Every region uses the two
+    phase step, so the KPIs stay close to a single TransportModel(two_phase=True) run.
+    model_params, e.g. workers, are passed on to every RegionModel; options that would
+    have every region write the same file, or step or stop regions on their own, raise
+    ValueError. Returns a MergedRun.
+    """
+    unshared = sorted(set(model_params) & {"trip_file", "trace_file", "profile_file", "event_driven", "steady_state"})
+    if unshared:
+        raise ValueError(f"{', '.join(unshared)} can't be used in a partitioned run")
+    if not model_params.pop("two_phase", True):
+        raise ValueError("regions always use the two phase step")
+    regions_x, regions_y = regions
+    if demand is None:
+        demand = generate_demand(num_drivers, size, seed_int, rate, steps, waiting_time, total_steps)
+    bounds = region_bounds(size, regions_x, regions_y)
+    parts = split_demand(demand, size, regions_x, regions_y)
+
+    conns = []
+    workers = []
+    for region, (part, bound) in enumerate(zip(parts, bounds)):
+        params = {"num_drivers": len(part.drivers), "size": size, "multi_pass": multi_pass, "seed_int": seed_int,
+                  "strategy": strategy, "waiting_time": waiting_time, "rate": rate, "total_steps": total_steps, **model_params}
+        parent, child = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=_region_worker, args=(child, region, bound, f"{seed_int}-{region}", params, part, claim_band))
+        worker.start()
+        conns.append(parent)
+        workers.append(worker)
+
+    incoming = [[] for _ in conns]
+    released = claimed = [[] for _ in conns]
+    for step in range(steps):
+        for conn, message in zip(conns, zip(incoming, released, claimed)):
+            conn.send(message)
+        incoming = [[] for _ in conns]
+        offers = []
+        for conn in conns:
+            exported_drivers, offer = conn.recv()
+            offers.append(offer)
+            for exported in exported_drivers:
+                current = exported[0]["current"]
+                incoming[region_of(current.x, current.y, size, regions_x, regions_y)].append(exported)
+        released, claimed = match_claims(offers, step + 1)
+        # the same order whichever region a car came from
+        for exported in incoming:
+            exported.sort(key=lambda item: item[0]["unique_id"])
+
+    kpis = KPITracker()
+    idle_times = []
+    for conn in conns:
+        conn.send(None)
+    for conn, exported in zip(conns, incoming):
+        region_kpis, region_idle = conn.recv()
+        kpis.merge(region_kpis)
+        idle_times += region_idle + [state["idle_time"] for state, _ in exported]
+    for worker in workers:
+        worker.join()
+    return MergedRun(kpis, idle_times, steps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the ridesharing simulation split into regions, one process each')
+
+    parser.add_argument('--multi_pass', action='store_true', help='Multi passenger system')
+    parser.add_argument('--num_drivers', type=int, default=100, help='Number of drivers in model')
+    parser.add_argument('--size', type=int, default=200, help='Grid size')
+    parser.add_argument('--seed', type=int, default=125, help='Random seed')
+    parser.add_argument('--strategy', type=int, default=2, help='Strategy to employ: QUEUE = 1, CLOSEST = 2, WAITING = 3, BATCH = 4')
+    parser.add_argument('--waiting_time', type=int, required=False, help='Passenger waiting time before they leave')
+    parser.add_argument('--rate', type=int, default=1, help='Rate at which new passenger requests come in')
+    parser.add_argument('--steps', type=int, default=1440, help='Steps to run')
+    parser.add_argument('--regions', type=int, nargs=2, default=(2, 1), metavar=('X', 'Y'), help='Regions across and down the grid')
+    parser.add_argument('--claim_band', type=int, default=10, help='Clients and idle cars this close to another region can be matched across the edge, 0 for none')
+    parser.add_argument('--single', action='store_true', help='Also run one two phase process on the same demand, for comparison')
+
+    args = parser.parse_args()
+    strategy = StepType(args.strategy)
+    demand = generate_demand(args.num_drivers, args.size, args.seed, args.rate, args.steps, args.waiting_time)
+
+    start = time.time()
+    merged = run_partitioned(args.num_drivers, args.size, args.multi_pass, args.seed, strategy, args.waiting_time, args.rate,
+                             args.steps, tuple(args.regions), demand, claim_band=args.claim_band)
+    print(f"partitioned {args.regions[0]}x{args.regions[1]}: {time.time() - start:.1f}s")
+    for name, value in merged.report().items():
+        print(f"  {name:16} {value}")
+
+    if args.single:
+        start = time.time()
+        model = TransportModel(args.num_drivers, args.size, args.multi_pass, args.seed, strategy, args.waiting_time, args.rate,
+                               demand=demand, sparse_grid=True, show_destinations=False, agent_data=False, two_phase=True)
+        for _ in range(args.steps):
+            model.step()
+        print(f"single process: {time.time() - start:.1f}s")
+        for name, reporter in KPI_REPORTERS.items():
+            print(f"  {name:16} {reporter(model)}")
@@ -0,0 +1,252 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: # only needed for the results store
+    pa = None
+
+from Agents import StepType
+from kpis import KPI_REPORTERS
+from trip_records import load_trips, DROPPED_OFF, ABANDONED, UNFINISHED
+
+PARTITIONS = ("strategy", "multi_pass", "num_drivers")
+
+if pa is not None:
+    PARTITION_SCHEMA = pa.schema([("strategy", pa.dictionary(pa.int8(), pa.string())), ("multi_pass", pa.bool_()),
+                                  ("num_drivers", pa.int32())])
+    # the run a row belongs to, on every row besides the partition columns
+    RUN_FIELDS = [("seed_int", pa.int64()), ("iteration", pa.int16()), ("size", pa.int32()), ("rate", pa.int16()),
+                  ("waiting_time", pa.int16()), ("total_steps", pa.int32())]
+    COUNTS = ("Step", "Requests", "PickedUp", "DroppedOff", "Abandoned", "WaitP50", "WaitP95", "DetourP95", "WarmupSteps", "SteadyStep")
+    SCHEMAS = {
+        # one row per run: its KPIs, any other model arguments as JSON
+        "runs": pa.schema(RUN_FIELDS + [(name, pa.int32() if name in COUNTS else pa.float64())
+                                        for name in ["Step", *KPI_REPORTERS, "WarmupSteps", "SteadyStep", "SteadyBacklog", "SteadyWait", "SteadyUtilisation"]]
+                          + [("params", pa.string())]),
+        # one row per passenger, wait and detour null unless picked up and dropped off
+        "passengers": pa.schema(RUN_FIELDS + [("sec_id", pa.int64()), ("outcome", pa.int8()), ("request_time", pa.int32()),
+                                              ("pickup_time", pa.int32()), ("dropoff_time", pa.int32()), ("shortest_distance", pa.int32()),
+                                              ("wait", pa.int32()), ("detour", pa.int32())]),
+        # one row per driver, at the end of the run
+        "drivers": pa.schema(RUN_FIELDS + [("unique_id", pa.int64()), ("steps_taken", pa.int32()), ("idle_time", pa.int32())]),
+    }
+
+
+def strategy_name(strategy):
+    # StepType, its value, its name or a notebook's "StepType.CLOSEST" -> "CLOSEST"
+    if isinstance(strategy, StepType):
+        return strategy.name
+    if isinstance(strategy, (int, np.integer)):
+        return StepType(int(strategy)).name
+    return str(strategy).rsplit(".", 1)[-1]
+
+
+class ResultStore:
+    """Run results as a partitioned parquet dataset, for the analysis notebooks.
+
+    Three tables, runs, passengers and drivers, each split into directories by strategy,
+    multi_pass and num_drivers (strategy=CLOSEST/multi_pass=True/num_drivers=3/...), with one
+    file per run and compact column types: strategy is categorical, times and counts are
+    small ints. load reads only the partitions and columns it is asked for, and aggregate
+    caches its result under root/_aggregates until the table's files change.
+    """
+
+    def __init__(self, root):
+        if pa is None:
+            raise ImportError("ResultStore needs pyarrow")
+        self.root = root
+        self._partitioning = ds.partitioning(PARTITION_SCHEMA, flavor="hive",
+                                             dictionaries={"strategy": pa.array([s.name for s in StepType])})
+
+
+    def _path(self, table, run, name):
+        parts = [f"{column}={strategy_name(run[column]) if column == 'strategy' else run[column]}" for column in PARTITIONS]
+        return os.path.join(self.root, table, *parts, name + ".parquet")
+
+    def has_run(self, name, run):
+        return os.path.exists(self._path("runs", run, name))
+
+    def write_run(self, name, run, kpis=None, passengers=None, drivers=None):
+        """Add one run under name: its parameters and KPIs, and its trip records if given.
+
+        run holds the model arguments, e.g. a sweep shard's, passengers and drivers are
+        columns as trip_records.load_trips returns them. A run written again is replaced.
+        """
+        common = {field: run.get(field) for field, _ in RUN_FIELDS}
+        extra = {key: value for key, value in run.items() if key not in common and key not in PARTITIONS and key not in (kpis or {})}
+        rows = {"runs": {**common, **(kpis or {}), "params": json.dumps(extra, default=str)}}
+        if passengers is not None:
+            dropped = passengers["dropoff_time"] != -1
+            picked = passengers["pickup_time"] != -1
+            rows["passengers"] = {
+                **common,
+                **{column: passengers[column] for column in ("sec_id", "outcome", "request_time", "pickup_time", "dropoff_time", "shortest_distance")},
+                "wait": pa.array(passengers["pickup_time"] - passengers["request_time"], mask=~picked),
+                "detour": pa.array(passengers["dropoff_time"] - passengers["pickup_time"] - passengers["shortest_distance"], mask=~dropped),
+            }
+        if drivers is not None:
+            rows["drivers"] = {**common, **{column: drivers[column] for column in ("unique_id", "steps_taken", "idle_time")}}
+
+        for table, columns in rows.items():
+            schema = SCHEMAS[table]
+            length = max((len(value) for value in columns.values() if isinstance(value, (np.ndarray, pa.Array))), default=1)
+            arrays = []
+            for field in schema:
+                value = columns.get(field.name)
+                if not isinstance(value, (np.ndarray, pa.Array)):
+                    value = [value] * length
+                arrays.append(pa.array(value, type=field.type) if not isinstance(value, pa.Array) else value.cast(field.type))
+            path = self._path(table, run, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(pa.Table.from_arrays(arrays, schema=schema), path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+
+    def dataset(self, table):
+        return ds.dataset(os.path.join(self.root, table), format="parquet", partitioning=self._partitioning,
+                          schema=pa.unify_schemas([SCHEMAS[table], PARTITION_SCHEMA]))
+
+    def _filter(self, where, equal):
+        # where (a pyarrow expression) and column == value, or column in a list of values, for every equal
+        expression = where
+        for column, value in equal.items():
+            values = value if isinstance(value, (list, tuple, range)) else [value]
+            if column == "strategy":
+                values = [strategy_name(strategy) for strategy in values]
+            test = ds.field(column).isin(list(values))
+            expression = test if expression is None else expression & test
+        return expression
+
+    def load(self, table, columns=None, where=None, **equal):
+        """DataFrame of table with only columns, of the rows matching where and equal.
+
+        e.g. store.load("passengers", ["strategy", "num_drivers", "sec_id", "wait"],
+        multi_pass=True, num_drivers=range(1, 6)). Filters on partition columns skip whole
+        directories, other filters skip row groups by their statistics.
+        """
+        return self.dataset(table).to_table(columns=columns, filter=self._filter(where, equal)).to_pandas()
+
+
+    def aggregate(self, table, by, columns, how="mean", where=None, **equal):
+        """columns of table aggregated with how (mean, sum, count, min, max, stddev, ...) over the groups by.
+
+        Computed by pyarrow without building a DataFrame of the rows, and kept in
+        root/_aggregates, keyed by the query and the names, sizes and times of the table's
+        files, so asking again is a single small read until a run is added or replaced.
+        """
+        by, columns = list(by), list(columns)
+        files = sorted(self.dataset(table).files)
+        stats = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in files]
+        key = json.dumps([table, by, columns, how, str(where), {k: str(v) for k, v in sorted(equal.items())}, stats])
+        path = os.path.join(self.root, "_aggregates", hashlib.sha1(key.encode()).hexdigest()[:16] + ".parquet")
+        if os.path.exists(path):
+            return pq.read_table(path).to_pandas().sort_values(by, ignore_index=True)
+
+        rows = self.dataset(table).to_table(columns=by + columns, filter=self._filter(where, equal))
+        result = rows.group_by(by).aggregate([(column, how) for column in columns])
+        result = result.rename_columns([name[:-len(how) - 1] if name.endswith("_" + how) else name for name in result.column_names])
+        result = result.select(by + columns)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(result, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return result.to_pandas().sort_values(by, ignore_index=True)
+
+
+def ingest_sweep(out_dir, store):
+    """Add the shards of a sweep in out_dir to store, with their trip records where written.
+
+    Runs already in the store are skipped. Returns the number of runs added.
+    """
+    added = 0
+    for name in sorted(os.listdir(out_dir)):
+        if not name.endswith(".json"):
+            continue
+        shard = name[:-len(".json")]
+        with open(os.path.join(out_dir, name)) as f:
+            row = json.load(f)
+        kpis = {field.name: row.pop(field.name) for field in SCHEMAS["runs"] if field.name in row and field.name not in dict(RUN_FIELDS)}
+        if store.has_run(shard, row):
+            continue
+        passengers = drivers = None
+        trips = os.path.join(out_dir, shard + ".npz")
+        if os.path.exists(trips):
+            passengers, drivers, _ = load_trips(trips)
+        store.write_run(shard, row, kpis, passengers, drivers)
+        added += 1
+    return added
+
+
+# legacy mesa.batch_run CSV columns kept by convert_csv, with their names in the store
+CSV_COLUMNS = {"RunId": "RunId", "iteration": "iteration", "Step": "Step", "num_drivers": "num_drivers", "size": "size",
+               "multi_pass": "multi_pass", "seed_int": "seed_int", "strategy": "strategy", "waiting_time": "waiting_time",
+               "rate": "rate", "total_steps": "total_steps", "AgentID": "AgentID", "Steps": "steps_taken", "IdleTime": "idle_time",
+               "sec_id": "sec_id", "request_time": "request_time", "pickup_time": "pickup_time", "dropoff_time": "dropoff_time",
+               "shortest distance": "shortest_distance"}
+
+
+def convert_csv(csv_path, store, chunksize=1_000_000):
+    """Add the runs of a legacy per step agent CSV written from mesa.batch_run, e.g. ridesharing.csv.
+
+    The file is read in chunks and only the last row of every agent of every run is kept,
+    as the notebooks do with drop_duplicates(keep="last"): for passengers their final times,
+    for drivers their steps and idle time at the end of the run. Passengers last seen
+    before the end of their run without a drop off abandoned. The runs table gets each
+    run's parameters only. Returns the number of runs added.
+    """
+    import pandas as pd
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = [column for column in CSV_COLUMNS if column in header]
+    last_rows = []
+    for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=chunksize):
+        chunk = chunk.rename(columns=CSV_COLUMNS)
+        last_rows.append(chunk.drop_duplicates(subset=["RunId", "AgentID"], keep="last"))
+    rows = pd.concat(last_rows, ignore_index=True).drop_duplicates(subset=["RunId", "AgentID"], keep="last")
+    last_step = rows.groupby("RunId")["Step"].transform("max")
+
+    added = 0
+    base = os.path.splitext(os.path.basename(csv_path))[0]
+    for run_id, group in rows.groupby("RunId", sort=True):
+        first = group.iloc[0]
+        run = {column: first[column] for column in ("num_drivers", "size", "multi_pass", "seed_int", "iteration", "rate", "total_steps", "waiting_time")
+               if column in group}
+        run = {column: None if pd.isna(value) else value.item() if hasattr(value, "item") else value for column, value in run.items()}
+        run["strategy"] = strategy_name(first["strategy"])
+        run["multi_pass"] = run["multi_pass"] in (True, "True", 1)
+
+        passengers = group[group["dropoff_time"].notna()]
+        drivers = group[group["steps_taken"].notna()]
+        outcome = np.where(passengers["dropoff_time"] != -1, DROPPED_OFF,
+                           np.where(passengers["Step"] < last_step[passengers.index], ABANDONED, UNFINISHED))
+        passenger_columns = {column: passengers[column].to_numpy(np.int64) for column in
+                             ("sec_id", "request_time", "pickup_time", "dropoff_time", "shortest_distance")}
+        passenger_columns["outcome"] = outcome.astype(np.int8)
+        driver_columns = {"unique_id": drivers["AgentID"].to_numpy(np.int64), "steps_taken": drivers["steps_taken"].to_numpy(np.int64),
+                          "idle_time": drivers["idle_time"].to_numpy(np.int64)}
+        store.write_run(f"{base}-{run_id}", run, {"Step": int(group["Step"].max())}, passenger_columns, driver_columns)
+        added += 1
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add sweep results or legacy batch_run CSVs to a partitioned parquet results store')
+
+    parser.add_argument('store', help='Directory of the store, created if missing')
+    parser.add_argument('sources', nargs='+', help='Sweep output directories or legacy .csv files')
+    parser.add_argument('--chunksize', type=int, default=1_000_000, help='CSV rows read at a time')
+
+    args = parser.parse_args()
+    store = ResultStore(args.store)
+    for source in args.sources:
+        if source.endswith(".csv"):
+            added = convert_csv(source, store, args.chunksize)
+        else:
+            added = ingest_sweep(source, store)
+        print(f"{source}: {added} runs added")
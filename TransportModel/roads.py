@@ -0,0 +1,183 @@
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    from scipy.spatial import cKDTree
+except ImportError: # only needed for road networks
+    sparse = csgraph = cKDTree = None
+
+
+class OpenGrid:
+    """Distances and routes on the open grid: manhattan distance, cars drive x first, then y.
+
+    The default for TransportModel. RoadNetwork offers the same methods on a street graph.
+    """
+
+    manhattan = True
+
+    def distance(self, src, dest):
+        return abs(src.x - dest.x) + abs(src.y - dest.y)
+
+    def distance_matrix(self, srcs, dests):
+        # len(srcs) x len(dests) array of distances
+        src_x = np.array([loc.x for loc in srcs])[:, None]
+        src_y = np.array([loc.y for loc in srcs])[:, None]
+        dest_x = np.array([loc.x for loc in dests])
+        dest_y = np.array([loc.y for loc in dests])
+        return np.abs(src_x - dest_x) + np.abs(src_y - dest_y)
+
+
+    def next_step(self, src, dest):
+        # cell a car at src drives to next on its way to dest, None once there
+        x, y = src.x, src.y
+        if x < dest.x:
+            return x + 1, y
+        if x > dest.x:
+            return x - 1, y
+        if y < dest.y:
+            return x, y + 1
+        if y > dest.y:
+            return x, y - 1
+        return None
+
+    def advance(self, src, dest, moves):
+        # cell reached from src after moves steps towards dest, in one go
+        x, y = src.x, src.y
+        dx = min(moves, abs(dest.x - x))
+        x += dx if dest.x > x else -dx
+        moves -= dx
+        y += moves if dest.y > y else -moves
+        return x, y
+
+
+    def is_enroute(self, src, dest, between):
+        # between lies on some shortest path from src to dest
+        return (min(src.x, dest.x) <= between.x <= max(src.x, dest.x)
+                and min(src.y, dest.y) <= between.y <= max(src.y, dest.y))
+
+    def snap(self, x, y):
+        return x, y
+
+
+class RoadNetwork:
+    """Shortest path distances and routes over a street graph whose nodes are grid cells.
+
+    Every edge takes a car one step. Only the largest strongly connected part of the graph
+    is kept, so every node can reach every other, and snap() moves a position onto its
+    closest node. Queries are answered from shortest path trees grown towards a destination,
+    each holding the distance and next node from every node on the graph: graphs of up to
+    all_pairs_limit nodes get the tree of every node up front, larger ones grow a tree the
+    first time a destination is asked for and keep the trees of recent destinations in an
+    LRU cache of cache_mib megabytes. Needs scipy.
+    """
+
+    manhattan = False
+
+    def __init__(self, edges, oneway=None, all_pairs_limit=3000, cache_mib=256):
+        if csgraph is None:
+            raise ImportError("RoadNetwork needs scipy")
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 4)
+        if oneway is None:
+            oneway = np.zeros(len(edges), dtype=bool)
+        oneway = np.asarray(oneway, dtype=bool)
+
+        # both directions of two way streets
+        src = np.concatenate([edges[:, :2], edges[~oneway, 2:]])
+        dest = np.concatenate([edges[:, 2:], edges[~oneway, :2]])
+        cells, index = np.unique(np.concatenate([src, dest]), axis=0, return_inverse=True)
+        index = index.reshape(-1)
+        graph = sparse.csr_matrix((np.ones(len(src)), (index[:len(src)], index[len(src):])), shape=(len(cells),) * 2)
+
+        _, labels = csgraph.connected_components(graph, directed=True, connection="strong")
+        keep = np.flatnonzero(labels == np.bincount(labels).argmax())
+        graph = graph[keep][:, keep]
+        graph.data[:] = 1 # repeated edges are summed by csr_matrix
+        self.cells = cells[keep]
+        self._node = {(int(x), int(y)): i for i, (x, y) in enumerate(self.cells)}
+        self._tree = cKDTree(self.cells)
+
+        # trees towards a destination are grown from it on the reversed graph
+        self._reverse = graph.T.tocsr()
+        self.all_pairs = len(self.cells) <= all_pairs_limit
+        if self.all_pairs:
+            # row t holds every node's distance to t and the node after it on the way
+            dist, pred = csgraph.shortest_path(self._reverse, unweighted=True, return_predecessors=True)
+            self._dist = dist.astype(np.int32)
+            self._next = pred.astype(np.int32)
+        else:
+            self._trees = OrderedDict() # destination node -> (distances, next nodes)
+            self.cache_size = max(8, cache_mib * 2**20 // (8 * len(self.cells)))
+
+
+    def _towards(self, target):
+        # every node's distance to target and next node on the way, from the LRU cache
+        tree = self._trees.get(target)
+        if tree is not None:
+            self._trees.move_to_end(target)
+            return tree
+        dist, pred = csgraph.shortest_path(self._reverse, unweighted=True, indices=target, return_predecessors=True)
+        tree = self._trees[target] = (dist.astype(np.int32), pred.astype(np.int32))
+        if len(self._trees) > self.cache_size:
+            self._trees.popitem(last=False)
+        return tree
+
+
+    def distance(self, src, dest):
+        node, target = self._node[src.x, src.y], self._node[dest.x, dest.y]
+        if self.all_pairs:
+            return int(self._dist[target, node])
+        return int(self._towards(target)[0][node])
+
+    def distance_matrix(self, srcs, dests):
+        nodes = [self._node[loc.x, loc.y] for loc in srcs]
+        targets = [self._node[loc.x, loc.y] for loc in dests]
+        if self.all_pairs:
+            return self._dist[np.ix_(targets, nodes)].T.astype(np.int64)
+        matrix = np.empty((len(nodes), len(targets)), dtype=np.int64)
+        for j, target in enumerate(targets):
+            matrix[:, j] = self._towards(target)[0][nodes]
+        return matrix
+
+
+    def _following(self, node, target):
+        if self.all_pairs:
+            return int(self._next[target, node])
+        return int(self._towards(target)[1][node])
+
+    def next_step(self, src, dest):
+        node, target = self._node[src.x, src.y], self._node[dest.x, dest.y]
+        if node == target:
+            return None
+        x, y = self.cells[self._following(node, target)]
+        return int(x), int(y)
+
+    def advance(self, src, dest, moves):
+        node, target = self._node[src.x, src.y], self._node[dest.x, dest.y]
+        for _ in range(moves):
+            node = self._following(node, target)
+        x, y = self.cells[node]
+        return int(x), int(y)
+
+
+    def is_enroute(self, src, dest, between):
+        return self.distance(src, between) + self.distance(between, dest) == self.distance(src, dest)
+
+    def snap(self, x, y):
+        # closest node to a cell, by manhattan distance
+        _, i = self._tree.query((x, y), p=1)
+        return int(self.cells[i][0]), int(self.cells[i][1])
+
+
+def load_road_network(path, **kwargs):
+    """RoadNetwork from an edge list file, one street per line: x1 y1 x2 y2, plus a fifth
+    column set to 1 for one way streets (x1, y1 to x2, y2 only). Lines starting with # are skipped.
+    Keyword arguments are passed on to RoadNetwork.
+    """
+    rows = np.loadtxt(path, dtype=np.int64, comments="#", ndmin=2)
+    if rows.shape[1] not in (4, 5):
+        raise ValueError(f"{path}: expected 4 or 5 columns, got {rows.shape[1]}")
+    oneway = rows[:, 4].astype(bool) if rows.shape[1] == 5 else None
+    return RoadNetwork(rows[:, :4], oneway, **kwargs)
@@ -0,0 +1,90 @@
+class RouteIndex:
+    """Reverse index from waiting passengers to the drivers whose current leg covers their pickup.
+
+    A driver's leg is the rectangle between where it stood when it set off towards
+    current_routes[0] and that waypoint. While the car keeps to it, the rectangle search_square
+    looks in, between the car and the waypoint, lies inside the leg. Legs are kept in coarse
+    buckets: a new request is pushed to the drivers whose leg covers its pickup, and a driver
+    starting a new leg collects the clients already inside it. A driver only asks for its
+    candidates when it moves, so search_square filters a handful of passengers instead of
+    scanning every cell between the car and its waypoint.
+
+    active holds the drivers that may have a candidate ahead: those handed a new client since
+    their last candidates call, or that found one then. On manhattan roads the rectangle only
+    shrinks as the car moves, so the rest have none until a new client is added to their leg.
+    """
+
+    def __init__(self, clients, bucket_size=16):
+        self.clients = clients
+        self.bucket_size = bucket_size
+        self._buckets = {} # (bucket x, bucket y) -> {driver: None}
+        self._legs = {} # driver -> (waypoint, from_x, to_x, from_y, to_y)
+        self._candidates = {} # driver -> {passenger: None}, clients seen inside its leg
+        self.active = set() # drivers that may have candidates, see above
+
+
+    def _keys(self, from_x, to_x, from_y, to_y):
+        size = self.bucket_size
+        return [(i, j) for i in range(from_x // size, to_x // size + 1) for j in range(from_y // size, to_y // size + 1)]
+
+
+    def register(self, driver, waypoint):
+        # start a new leg from driver.current to waypoint
+        self.unregister(driver)
+        current = driver.current
+        rect = (min(current.x, waypoint.x), max(current.x, waypoint.x), min(current.y, waypoint.y), max(current.y, waypoint.y))
+        self._legs[driver] = (waypoint,) + rect
+        for key in self._keys(*rect):
+            self._buckets.setdefault(key, {})[driver] = None
+        self._candidates[driver] = dict.fromkeys(self.clients.in_rect(*rect))
+        if self._candidates[driver]:
+            self.active.add(driver)
+
+    def unregister(self, driver):
+        leg = self._legs.pop(driver, None)
+        if leg is None:
+            return
+        for key in self._keys(*leg[1:]):
+            bucket = self._buckets[key]
+            del bucket[driver]
+            if not bucket:
+                del self._buckets[key]
+        del self._candidates[driver]
+        self.active.discard(driver)
+
+
+    def add(self, passenger):
+        # a new client, handed to every driver whose leg covers its pickup
+        src = passenger.src
+        bucket = self._buckets.get((src.x // self.bucket_size, src.y // self.bucket_size))
+        if not bucket:
+            return
+        for driver in bucket:
+            _, from_x, to_x, from_y, to_y = self._legs[driver]
+            if from_x <= src.x <= to_x and from_y <= src.y <= to_y:
+                self._candidates[driver][passenger] = None
+                self.active.add(driver)
+
+
+    def candidates(self, driver):
+        # clients whose pickup lies between driver.current and current_routes[0], in the order they were seen
+        waypoint = driver.current_routes[0][0]
+        current = driver.current
+        leg = self._legs.get(driver)
+        if leg is None or leg[0] is not waypoint or not (leg[1] <= current.x <= leg[2] and leg[3] <= current.y <= leg[4]):
+            # new waypoint, or the car left its leg (possible on a road network)
+            self.register(driver, waypoint)
+
+        from_x, to_x = min(current.x, waypoint.x), max(current.x, waypoint.x)
+        from_y, to_y = min(current.y, waypoint.y), max(current.y, waypoint.y)
+        clients = self.clients
+        # passengers that are no longer waiting are dropped for good
+        seen = {passenger: None for passenger in self._candidates[driver] if passenger in clients}
+        self._candidates[driver] = seen
+        found = [passenger for passenger in seen
+                 if from_x <= passenger.src.x <= to_x and from_y <= passenger.src.y <= to_y]
+        if found:
+            self.active.add(driver)
+        else:
+            self.active.discard(driver)
+        return found
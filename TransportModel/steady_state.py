@@ -0,0 +1,131 @@
+import numpy as np
+
+BATCHES = 20 # batch means in the steady state interval
+T_QUANTILE = 2.093 # two sided 95% t quantile with BATCHES - 1 degrees of freedom
+
+
+def _batch_means(values, weights, size, count):
+    # means of count batches of size steps from the end of values, weighted by weights (e.g. drop offs) if given
+    start = len(values) - size * count
+    totals = np.asarray(values[start:], dtype=float).reshape(count, size).sum(axis=1)
+    if weights is None:
+        return totals / size
+    weights = np.asarray(weights[start:], dtype=float).reshape(count, size).sum(axis=1)
+    return totals[weights > 0] / weights[weights > 0]
+
+
+def mser(values, weights=None, batch=5):
+    """MSER-5 truncation point of a series, in steps, or None while the series still drifts.
+
+    values are averaged over batches of batch steps, and the cut d picked where the
+    variance of what is left over the square of its length, sum((y - mean)^2) / (m - d)^2,
+    is smallest. A minimum past the first half of the batches means the series has not
+    settled yet; the last few batches are left out of the search. With weights, batches are ratios
+    of totals and batches with no weight, e.g. no drop offs, count as the overall ratio.
+    """
+    m = len(values) // batch
+    if m < 8:
+        return None
+    values, weights = values[:m * batch], None if weights is None else weights[:m * batch]
+    if weights is None:
+        means = _batch_means(values, None, batch, m)
+    else:
+        totals = np.asarray(values, dtype=float).reshape(m, batch).sum(axis=1)
+        counts = np.asarray(weights, dtype=float).reshape(m, batch).sum(axis=1)
+        means = np.where(counts > 0, totals / np.maximum(counts, 1), totals.sum() / max(counts.sum(), 1))
+    # sums over means[d:] for every d, from the back
+    left = np.arange(m, 0, -1)
+    total = np.cumsum(means[::-1])[::-1]
+    squares = np.cumsum((means ** 2)[::-1])[::-1]
+    scores = (squares - total ** 2 / left) / left ** 2
+    scores = scores[:m - 5]
+    # earliest of the cuts that tie for the minimum, e.g. every cut of a series that never changes
+    d = int(np.argmax(scores <= scores.min() + 1e-9 * abs(scores.min()) + 1e-12))
+    return None if d > m // 2 else d * batch
+
+
+def batch_means(values, weights=None):
+    # mean and half width of the 95% batch means interval over BATCHES equal batches, the oldest steps left over
+    means = _batch_means(values, weights, len(values) // BATCHES, BATCHES)
+    if len(means) < 2:
+        return None, np.inf
+    return means.mean(), T_QUANTILE * means.std(ddof=1) / np.sqrt(len(means))
+
+
+class SteadyState:
+    """Stops a run once its backlog, waiting time and utilisation have settled.
+
+    Every step records the number of unassigned requests, the share of cars with a route and
+    the waiting times of that step's drop offs. Every check_every steps from min_steps on,
+    the warm up is cut off each series where MSER-5 puts it, taking the latest of the three,
+    and the rest is split into BATCHES batch means. The run has converged once, on confirm
+    checks in a row, every series' 95% interval is within precision of its mean, or within
+    its absolute tolerance for series close to zero, e.g. an empty backlog.
+    """
+
+    def __init__(self, precision=0.1, tolerance=None, check_every=50, min_steps=200, confirm=2):
+        self.precision = precision
+        self.tolerance = {"Backlog": 0.5, "Wait": 0.5, "Utilisation": 1.0, **(tolerance or {})}
+        self.check_every = check_every
+        self.min_steps = min_steps
+        self.confirm = confirm
+
+        self.backlog = []
+        self.utilisation = []
+        self.wait_total = []
+        self.wait_count = []
+        self._wait_seen = (0, 0.0) # kpis.wait count and total at the last step
+        self._stable = 0
+        self.converged_at = None # step the run converged at
+        self.truncation = None # warm up steps cut off, as of the last check
+
+
+    def observe(self, model):
+        # record the step model just made; True once the run has converged
+        wait = model.kpis.wait
+        total = wait.mean * wait.count
+        self.backlog.append(len(model.clients))
+        self.utilisation.append(100 * sum(1 for driver in model.drivers if driver.current_routes) / max(len(model.drivers), 1))
+        self.wait_count.append(wait.count - self._wait_seen[0])
+        self.wait_total.append(total - self._wait_seen[1])
+        self._wait_seen = (wait.count, total)
+
+        steps = len(self.backlog)
+        if self.converged_at is None and steps >= self.min_steps and steps % self.check_every == 0:
+            estimates = self.estimates()
+            settled = estimates is not None and all(
+                mean is not None and half_width <= max(self.precision * abs(mean), self.tolerance[name]) for name, (mean, half_width) in estimates.items())
+            self._stable = self._stable + 1 if settled else 0
+            if self._stable >= self.confirm:
+                self.converged_at = model.schedule.steps
+        return self.converged_at is not None
+
+
+    def estimates(self):
+        """{series: (mean, half width)} over the steps after the warm up, or None if it hasn't ended.
+
+        Sets truncation. Waiting time is left out of runs without a drop off.
+        """
+        series = {"Backlog": (self.backlog, None), "Utilisation": (self.utilisation, None)}
+        if sum(self.wait_count):
+            series["Wait"] = (self.wait_total, self.wait_count)
+
+        cuts = [mser(values, weights) for values, weights in series.values()]
+        self.truncation = None if None in cuts else max(cuts)
+        if self.truncation is None:
+            return None
+        if len(self.backlog) - self.truncation < 2 * BATCHES:
+            return None
+        estimates = {}
+        for name, (values, weights) in series.items():
+            estimates[name] = batch_means(values[self.truncation:], None if weights is None else weights[self.truncation:])
+        return estimates
+
+
+    def report(self):
+        # warm up cut, step converged at (None if it didn't) and the steady state means, for checkpoint.report
+        estimates = self.estimates() or {}
+        row = {"WarmupSteps": self.truncation, "SteadyStep": self.converged_at}
+        for name in ("Backlog", "Wait", "Utilisation"):
+            row["Steady" + name] = float(estimates[name][0]) if estimates.get(name, (None,))[0] is not None else None
+        return row
@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    from scipy.stats import t as t_dist
+except ImportError: # only needed for adaptive_sweep
+    t_dist = None
+
+from TransportModel import TransportModel
+from Agents import StepType
+from checkpoint import fork_map, report
+
+
+def expand(parameters, iterations=1):
+    # every combination of parameters, like mesa.batch_run, repeated for each iteration
+    names = list(parameters)
+    values = [value if isinstance(value, (list, tuple, range)) else [value] for value in parameters.values()]
+    runs = []
+    for combination in itertools.product(*values):
+        for iteration in range(iterations):
+            runs.append(dict(zip(names, combination), iteration=iteration))
+    return runs
+
+
+def _plain(run):
+    # json friendly copy of a run's parameters
+    return {name: value.value if isinstance(value, StepType) else value for name, value in run.items()}
+
+
+def shard_name(run):
+    # stable file name for a run, so a resumed sweep finds the shards it already wrote
+    key = json.dumps(_plain(run), sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _model(run, out_dir, event_driven, trips):
+    params = {key: value for key, value in run.items() if key not in ("iteration", "warmup")}
+    params["strategy"] = StepType(params["strategy"])
+    trip_tmp = os.path.join(out_dir, shard_name(run) + ".tmp.npz") if trips else None
+    return TransportModel(**params, event_driven=event_driven, trip_file=trip_tmp, agent_data=False, show_destinations=False)
+
+
+def _finish(model, run, out_dir, max_steps, trips):
+    # step model on to max_steps, then write the shard of run
+    name = shard_name(run)
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+    model.finish()
+
+    row = dict(_plain(run), **report(model))
+    if trips:
+        os.replace(model.trips.path, os.path.join(out_dir, name + ".npz"))
+    path = os.path.join(out_dir, name + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(row, f)
+    os.replace(path + ".tmp", path)
+    return name
+
+
+def run_one(job):
+    """Run a single model to max_steps and write its summary row to out_dir/<shard>.json.
+
+    With trips set, the passenger and driver trip records are written next to it as <shard>.npz.
+    Files are written under a temporary name and renamed, so a shard on disk is always complete.
+    """
+    run, out_dir, max_steps, event_driven, trips = job
+    model = _model(run, out_dir, event_driven, trips)
+    return [_finish(model, run, out_dir, max_steps, trips)]
+
+
+def run_group(job):
+    """Warm up one model for warmup steps, then fork it into every run of the group.
+
+    The runs differ only in strategy and multi_pass: the first run's are used for the
+    warm up, and each forked copy switches to its own before stepping on to max_steps.
+    """
+    runs, out_dir, max_steps, event_driven, trips, warmup = job
+    model = _model(runs[0], out_dir, event_driven, trips)
+    while model.running and model.schedule.steps < warmup:
+        model.step()
+
+    def branch(run):
+        def task(model):
+            model.configure(strategy=StepType(run["strategy"]), multi_pass=run["multi_pass"])
+            if trips:
+                model.trips.path = os.path.join(out_dir, shard_name(run) + ".tmp.npz")
+            return _finish(model, run, out_dir, max_steps, trips)
+        return task
+
+    # one branch at a time, the pool already has a worker per cpu
+    return fork_map(model, [branch(run) for run in runs], processes=1)
+
+
+def sweep(parameters, out_dir, iterations=1, max_steps=1000, processes=None, chunksize=None,
+          event_driven=False, trips=False, warmup=0, paired=False, log=sys.stderr):
+    """Run every combination of parameters across a process pool, one result shard per run.
+
+    Runs whose shard already exists in out_dir are skipped, so an interrupted sweep picks up
+    where it stopped. Progress, runs/sec and ETA are printed to log. Returns the number of runs done.
+
+    With warmup, runs that differ only in strategy and multi_pass share their first warmup
+    steps: one model is warmed up and forked into each of them (see run_group). With paired,
+    iteration i runs as TransportModel(replication=i), so runs that differ only in strategy
+    see the same requests and patience and can be compared pairwise.
+    """
+    return run_all(_replicate(expand(parameters, iterations), paired), out_dir, max_steps, processes, chunksize,
+                   event_driven, trips, warmup, log)
+
+
+def _replicate(runs, paired):
+    if paired:
+        for run in runs:
+            run["replication"] = run["iteration"]
+    return runs
+
+
+def run_all(runs, out_dir, max_steps=1000, processes=None, chunksize=None, event_driven=False, trips=False,
+            warmup=0, log=sys.stderr):
+    # the runs of a sweep, each a dict of TransportModel arguments and its iteration
+    os.makedirs(out_dir, exist_ok=True)
+    if warmup:
+        for run in runs:
+            run["warmup"] = warmup
+    todo = [run for run in runs if not os.path.exists(os.path.join(out_dir, shard_name(run) + ".json"))]
+    if log:
+        print(f"{len(runs)} runs, {len(runs) - len(todo)} already done", file=log)
+    if not todo:
+        return 0
+
+    if warmup:
+        groups = {}
+        for run in todo:
+            key = json.dumps(_plain({name: value for name, value in run.items() if name not in ("strategy", "multi_pass")}), sort_keys=True)
+            groups.setdefault(key, []).append(run)
+        worker = run_group
+        jobs = [(group, out_dir, max_steps, event_driven, trips, warmup) for group in groups.values()]
+    else:
+        worker = run_one
+        jobs = [(run, out_dir, max_steps, event_driven, trips) for run in todo]
+
+    processes = processes or os.cpu_count()
+    # a few chunks per worker keeps the pool busy without paying for a round trip per run
+    chunksize = chunksize or max(1, len(jobs) // (processes * 4))
+
+    start = time.time()
+    done = 0
+    with multiprocessing.Pool(processes) as pool:
+        for names in pool.imap_unordered(worker, jobs, chunksize=chunksize):
+            done += len(names)
+            if log:
+                rate = done / (time.time() - start)
+                eta = (len(todo) - done) / rate
+                print(f"\r{done}/{len(todo)} runs, {rate:.2f} runs/s, ETA {eta:.0f}s", end="", file=log, flush=True)
+    if log:
+        print(file=log)
+    return len(todo)
+
+
+def _half_width(values, confidence):
+    # half width of the t confidence interval on the mean of values
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return np.inf
+    return t_dist.ppf((1 + confidence) / 2, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values))
+
+
+def adaptive_sweep(parameters, out_dir, kpi="MeanWait", precision=1.0, confidence=0.95, min_iterations=3,
+                   max_iterations=50, paired=True, max_steps=1000, processes=None, event_driven=False,
+                   warmup=0, log=sys.stderr):
+    """Replicate every combination of parameters until the confidence interval on kpi is tight enough.
+
+    Every combination starts with min_iterations runs. After each round the half width of the
+    interval on its mean kpi is checked against precision, in the kpi's own units, and the
+    combinations short of it get more runs, as many as the current spread suggests they need
+    (at most double), up to max_iterations.
+
+    With paired (the default) runs use TransportModel(replication=i), and combinations that
+    differ only in strategy are replicated together: the interval checked is the one on the
+    difference in kpi from the first strategy, replication by replication, which the shared
+    requests and patience keep far narrower than either mean's. Returns a DataFrame with the
+    mean and half width of every combination, and with paired the difference and its half width.
+    """
+    import pandas as pd
+
+    if t_dist is None:
+        raise ImportError("adaptive_sweep needs scipy")
+    points = expand(parameters)
+    for point in points:
+        del point["iteration"]
+    if paired:
+        groups = {}
+        for point in points:
+            key = json.dumps(_plain({name: value for name, value in point.items() if name != "strategy"}), sort_keys=True)
+            groups.setdefault(key, []).append(point)
+        groups = list(groups.values())
+    else:
+        groups = [[point] for point in points]
+
+    def runs_of(point, iterations):
+        runs = _replicate([dict(point, iteration=i) for i in range(iterations)], paired)
+        if warmup:
+            for run in runs:
+                run["warmup"] = warmup
+        return runs
+
+    def values(point, iterations):
+        rows = []
+        for run in runs_of(point, iterations):
+            with open(os.path.join(out_dir, shard_name(run) + ".json")) as f:
+                rows.append(json.load(f)[kpi])
+        return np.array([np.nan if value is None else value for value in rows], dtype=float)
+
+    def spread(group, iterations):
+        # widest interval of the group: on each mean, or on each difference from the first strategy
+        kpis = [values(point, iterations) for point in group]
+        if len(group) > 1:
+            kpis = [kpi_values - kpis[0] for kpi_values in kpis[1:]]
+        return max(_half_width(kpi_values[~np.isnan(kpi_values)], confidence) for kpi_values in kpis)
+
+    iterations = [min_iterations] * len(groups)
+    done = [False] * len(groups)
+    rounds = 0
+    while not all(done):
+        rounds += 1
+        runs = [run for group, n, finished in zip(groups, iterations, done) if not finished
+                for point in group for run in runs_of(point, n)]
+        run_all(runs, out_dir, max_steps, processes, None, event_driven, False, warmup, log)
+        for g, group in enumerate(groups):
+            if done[g]:
+                continue
+            n = iterations[g]
+            width = spread(group, n)
+            if width <= precision or n >= max_iterations:
+                done[g] = True
+            else:
+                needed = int(np.ceil(n * (width / precision) ** 2)) if np.isfinite(width) else 2 * n
+                iterations[g] = min(max_iterations, max(n + 1, min(needed, 2 * n)))
+        if log:
+            print(f"round {rounds}: {sum(done)}/{len(groups)} combinations within +-{precision} {kpi}", file=log)
+
+    rows = []
+    for group, n in zip(groups, iterations):
+        first = values(group[0], n)
+        for point in group:
+            kpi_values = values(point, n)
+            row = dict(_plain(point), iterations=n, **{kpi: np.nanmean(kpi_values),
+                       "half_width": _half_width(kpi_values[~np.isnan(kpi_values)], confidence)})
+            if paired and len(group) > 1:
+                difference = kpi_values - first
+                row["difference"] = np.nanmean(difference)
+                row["difference_half_width"] = _half_width(difference[~np.isnan(difference)], confidence)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def load_results(out_dir):
+    # one row per finished run, as a DataFrame
+    import pandas as pd
+
+    rows = []
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith(".json"):
+            with open(os.path.join(out_dir, name)) as f:
+                rows.append(json.load(f))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of the ridesharing simulation, one result file per run')
+
+    parser.add_argument('params', help='JSON object, or path to a JSON file, mapping TransportModel arguments to a value or list of values')
+    parser.add_argument('out_dir', help='Directory for the result shards; existing shards are skipped')
+    parser.add_argument('--iterations', type=int, default=1, help='Repetitions of every parameter combination')
+    parser.add_argument('--max_steps', type=int, default=1440, help='Steps per run')
+    parser.add_argument('--processes', type=int, required=False, help='Worker processes, defaults to the number of CPUs')
+    parser.add_argument('--chunksize', type=int, required=False, help='Runs handed to a worker at a time')
+    parser.add_argument('--event_driven', action='store_true', help='Use the event driven schedule, most useful with sparse demand')
+    parser.add_argument('--trips', action='store_true', help='Also write the trip records of every run')
+    parser.add_argument('--warmup', type=int, default=0, help='Steps shared by runs that differ only in strategy and multi_pass')
+    parser.add_argument('--paired', action='store_true', help='Give every iteration its own demand, patience and activation streams, the same for every strategy')
+    parser.add_argument('--adaptive', type=str, metavar='KPI', required=False, help='Add paired iterations until the interval on this KPI, or on its difference between strategies, is within --precision')
+    parser.add_argument('--precision', type=float, default=1.0, help='Half width of the 95%% interval to reach with --adaptive')
+    parser.add_argument('--max_iterations', type=int, default=50, help='Most iterations of a combination with --adaptive')
+    parser.add_argument('--store', type=str, required=False, help='Also add the results to this results_store.ResultStore directory')
+
+    args = parser.parse_args()
+    if os.path.exists(args.params):
+        with open(args.params) as f:
+            parameters = json.load(f)
+    else:
+        parameters = json.loads(args.params)
+
+    if args.adaptive:
+        summary = adaptive_sweep(parameters, args.out_dir, args.adaptive, args.precision, min_iterations=max(args.iterations, 2),
+                                 max_iterations=args.max_iterations, max_steps=args.max_steps, processes=args.processes,
+                                 event_driven=args.event_driven, warmup=args.warmup)
+        print(summary.to_string(index=False))
+    else:
+        sweep(parameters, args.out_dir, args.iterations, args.max_steps, args.processes, args.chunksize,
+              args.event_driven, args.trips, args.warmup, args.paired)
+    if args.store:
+        from results_store import ResultStore, ingest_sweep
+        print(f"{ingest_sweep(args.out_dir, ResultStore(args.store))} runs added to {args.store}", file=sys.stderr)
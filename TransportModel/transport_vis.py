@@ -1,7 +1,9 @@
 import argparse
 import mesa
-from TransportModel import TransportModel, Driver, Passenger
+from TransportModel import TransportModel
 from Agents import StepType
+from event_trace import TraceReplay, read_header
+from live_vis import serve
 
 
 def agent_portrayal(agent):
@@ -12,10 +14,11 @@ def agent_portrayal(agent):
         "Layer": 0.1,
         "r": 0.5,
     }
-    if type(agent) is Driver:
+    # by type name, so replayed agents from event_trace.TraceReplay are drawn the same way
+    if agent.type == "Driver":
         portrayal["Shape"] = "Images\icons8-people-in-car-side-view-50.png"
        
-    elif type(agent) is Passenger:
+    elif agent.type == "Passenger":
         portrayal["Shape"] = "Images\icons8-body-type-short-50.png"
 
     else:
@@ -27,16 +30,23 @@ def agent_portrayal(agent):
 def run_vis():
     parser = argparse.ArgumentParser(description='Run ridesharing simulation visualisation')
 
-    parser.add_argument('--multi_pass', type=bool, required=False, help='Set to True for multi passenger system of False for single passenger')
+    parser.add_argument('--multi_pass', action='store_true', help='Multi passenger system, single passenger if left out')
     parser.add_argument('--num_drivers', type=int, required=False, help='Number of drivers in model')
     parser.add_argument('--size', type=int, required=False, help='Grid size')
     parser.add_argument('--seed', type=int, required=False, help='Random seed')
-    parser.add_argument('--strategy', type=int, required=False, help='Strategy to employ: QUEUE = 1, CLOSEST = 2, WAITING = 3')
+    parser.add_argument('--strategy', type=int, required=False, help='Strategy to employ: QUEUE = 1, CLOSEST = 2, WAITING = 3, BATCH = 4')
     parser.add_argument('--waiting_time', type=int, required=False, help='Passenger waiting time before they leave')
     parser.add_argument('--rate', type=int, required=False, help='Rate at which new passenger requests come in')
+    parser.add_argument('--road_network', type=str, required=False, help='Edge list file of a street graph to drive on instead of the open grid')
+    parser.add_argument('--replay', type=str, required=False, help='Play back an event trace file instead of running the model')
+    parser.add_argument('--sparse_grid', action='store_true', help='Only store occupied cells, for large grids')
+    parser.add_argument('--event_driven', action='store_true', help='Only step agents that have something to do, most useful with sparse demand')
+    parser.add_argument('--live', action='store_true', help='Run the model in its own process at full speed and stream what changes to the browser')
+    parser.add_argument('--fps', type=int, default=10, help='Frames per second sent to the browser with --live')
+    parser.add_argument('--steps', type=int, default=0, help='Steps to run with --live, 0 for no limit')
 
     args = parser.parse_args()
-    multi_pass = args.multi_pass if args.multi_pass else False
+    multi_pass = args.multi_pass
     num_drivers = args.num_drivers if args.num_drivers else 5
     seed = args.seed if args.seed else 125
     size = args.size if args.size else 10
@@ -45,20 +55,37 @@ def run_vis():
     rate = args.rate if args.rate else 5
 
 
-    grid = mesa.visualization.CanvasGrid(agent_portrayal,10,10,500,500)
+    if args.replay:
+        width, height = read_header(args.replay)
+        grid = mesa.visualization.CanvasGrid(agent_portrayal,width,height,500,500)
+        server = mesa.visualization.ModularServer(TraceReplay, [grid], 'Transport Model (replay)', {'path': args.replay})
+        server.port = 8521 # default
+        server.launch()
+        return
+
+    params = {'num_drivers': num_drivers,
+              'size' : size,
+              'multi_pass' : multi_pass,
+              'seed_int': seed,
+              'strategy' : strategy,
+              'waiting_time': waiting_time,
+              'rate': rate,
+              'road_network': args.road_network,
+              'sparse_grid': args.sparse_grid,
+              'event_driven': args.event_driven
+             }
+
+    if args.live:
+        serve(params, args.steps, args.fps)
+        return
+
+    grid = mesa.visualization.CanvasGrid(agent_portrayal,size,size,500,500)
 
 
     # configure and run the server
     server = mesa.visualization.ModularServer(
         TransportModel, [grid], 'Transport Model',
-        {'num_drivers': num_drivers,
-         'size' : size,
-         'multi_pass' : multi_pass,
-         'seed_int': seed,
-         'strategy' : strategy,
-         'waiting_time': waiting_time,
-         'rate': rate
-        }
+        params
     )
 
     server.port = 8521 # default
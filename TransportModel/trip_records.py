@@ -0,0 +1,92 @@
+import json
+from array import array
+
+import numpy as np
+
+# passenger outcomes
+DROPPED_OFF = 0
+ABANDONED = 1
+UNFINISHED = 2 # still waiting or in a car when the run ended
+
+# column name -> array typecode
+PASSENGER_COLUMNS = {
+    "unique_id": "q",
+    "sec_id": "q",
+    "outcome": "b",
+    "request_time": "i",
+    "latest_pickup_time": "i",
+    "pickup_time": "i",
+    "dropoff_time": "i",
+    "shortest_distance": "i",
+    "src_x": "i",
+    "src_y": "i",
+    "dest_x": "i",
+    "dest_y": "i",
+}
+
+DRIVER_COLUMNS = {
+    "unique_id": "q",
+    "steps_taken": "i",
+    "idle_time": "i",
+}
+
+
+class TripRecorder:
+    """Collects one row per passenger as they finish and one row per driver at the end of a run.
+
+    Rows are kept in typed columns and written to a compressed .npz file on close, replacing
+    per step agent snapshots for analysis. Load them back with load_trips.
+    """
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.meta = meta or {}
+        self.passengers = {name: array(code) for name, code in PASSENGER_COLUMNS.items()}
+        self.drivers = {name: array(code) for name, code in DRIVER_COLUMNS.items()}
+        self.closed = False
+
+
+    def passenger_done(self, passenger, outcome):
+        if self.closed:
+            raise ValueError("trip records already written")
+        row = self.passengers
+        row["unique_id"].append(passenger.unique_id)
+        row["sec_id"].append(passenger.secondary_id)
+        row["outcome"].append(outcome)
+        row["request_time"].append(passenger.request_time)
+        row["latest_pickup_time"].append(passenger.latest_pickup_time)
+        row["pickup_time"].append(passenger.pickup_time)
+        row["dropoff_time"].append(passenger.dropoff_time)
+        row["shortest_distance"].append(passenger.shortest_distance)
+        row["src_x"].append(passenger.src.x)
+        row["src_y"].append(passenger.src.y)
+        row["dest_x"].append(passenger.dest.x)
+        row["dest_y"].append(passenger.dest.y)
+
+
+    def driver_done(self, driver):
+        if self.closed:
+            raise ValueError("trip records already written")
+        row = self.drivers
+        row["unique_id"].append(driver.unique_id)
+        row["steps_taken"].append(driver.steps_taken)
+        row["idle_time"].append(driver.idle_time)
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        columns = {f"passengers.{name}": np.asarray(values) for name, values in self.passengers.items()}
+        columns.update({f"drivers.{name}": np.asarray(values) for name, values in self.drivers.items()})
+        columns["meta"] = np.array(json.dumps(self.meta, default=str))
+        np.savez_compressed(self.path, **columns)
+
+
+def load_trips(path):
+    # returns (passengers, drivers, meta), the first two as dicts of numpy columns
+    with np.load(path) as data:
+        passengers = {name.split(".", 1)[1]: data[name] for name in data.files if name.startswith("passengers.")}
+        drivers = {name.split(".", 1)[1]: data[name] for name in data.files if name.startswith("drivers.")}
+        meta = json.loads(str(data["meta"]))
+    return passengers, drivers, meta
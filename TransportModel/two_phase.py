@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+
+import mesa
+import numpy as np
+
+from Agents import StepType
+
+_roads = None # distance backend of a worker process, see _init_worker
+
+
+def _init_worker(roads):
+    global _roads
+    _roads = roads
+
+
+def rank_clients(job, roads=None):
+    """Clients each driver of a shard can reach in time, best first, at most keep of them.
+
+    job is (driver locations, client src locations, latest pickup times, request times,
+    strategy value, current step, keep), clients in arrival order. Clients are ranked
+    like set_next_dest picks them: by distance for CLOSEST, latest pickup time for WAITING
+    and request time for QUEUE, ties going to the earliest arrival. Returns one list of
+    client indexes per driver.
+    """
+    locations, srcs, latest, requested, strategy, now, keep = job
+    distance = (roads or _roads).distance_matrix(locations, srcs)
+    feasible = distance + now <= latest
+
+    if strategy == StepType.CLOSEST.value:
+        key = distance
+    elif strategy == StepType.WAITING.value:
+        key = np.broadcast_to(latest, distance.shape)
+    else:
+        key = np.broadcast_to(requested, distance.shape)
+    # one int per client with the arrival index as tie break, unreachable clients last
+    num_clients = distance.shape[1]
+    key = np.where(feasible, key * num_clients + np.arange(num_clients), np.iinfo(np.int64).max)
+
+    keep = min(keep, num_clients)
+    best = np.argpartition(key, keep - 1, axis=1)[:, :keep]
+    best = np.take_along_axis(best, np.argsort(np.take_along_axis(key, best, axis=1), axis=1), axis=1)
+    return [[index for index in row if feasible[i, index]] for i, row in enumerate(best.tolist())]
+
+
+class TwoPhaseActivation(mesa.time.BaseScheduler):
+    """Step for large fleets in two phases: drivers decide in parallel, then commit in a fixed order.
+
+    Phase one ranks the waiting clients for every idle driver against a snapshot of
+    model.clients, sharded across workers processes once there are more than
+    parallel_threshold driver and client pairs to rank. Phase two walks the drivers in
+    unique_id order and each claims the best passenger on its list that no driver before it
+    took. Then every agent steps in unique_id order, so drivers pick up, drop off, move and,
+    with multi_pass, take passengers en route one after the other.
+
+    Neither the scheduler's rng nor the number of workers play a part, so a seed gives the
+    same run however the work is split. Unlike RandomActivation, a client an idle driver
+    can't reach in time stays in model.clients for the others instead of being dropped.
+    """
+
+    def __init__(self, model, workers=0, parallel_threshold=50_000):
+        super().__init__(model)
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self._pool = None
+        self._pool_pid = None # process that started the pool, a forked copy of the model starts its own
+
+
+    def dispatch(self):
+        # phase one and the claims of phase two, for drivers without a route
+        model = self.model
+        idle = [driver for driver in model.drivers if not driver.current_routes and driver.step_type != StepType.BATCH]
+        if not idle or not model.clients:
+            return
+        passengers = list(model.clients)
+        srcs = [passenger.src for passenger in passengers]
+        latest = np.array([passenger.latest_pickup_time for passenger in passengers], dtype=np.int64)
+        requested = np.array([passenger.request_time for passenger in passengers], dtype=np.int64)
+        strategy = model.strategy.value
+        # a driver never needs more options than there are drivers claiming before it
+        keep = len(idle)
+
+        if self.workers and len(idle) * len(passengers) > self.parallel_threshold:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.workers, _init_worker, (model.roads,))
+                self._pool_pid = os.getpid()
+            shards = np.array_split(np.arange(len(idle)), self.workers)
+            jobs = [([idle[i].current for i in shard], srcs, latest, requested, strategy, self.steps, keep) for shard in shards if len(shard)]
+            rankings = [ranked for shard in self._pool.map(rank_clients, jobs) for ranked in shard]
+        else:
+            rankings = rank_clients(([driver.current for driver in idle], srcs, latest, requested, strategy, self.steps, keep), model.roads)
+
+        for driver, ranked in zip(idle, rankings):
+            for index in ranked:
+                passenger = passengers[index]
+                if passenger in model.clients:
+                    driver.current_routes = [(passenger.src, passenger), (passenger.dest, passenger)]
+                    model.clients.remove(passenger)
+                    break
+
+
+    def step(self):
+        self.dispatch()
+        for agent_key in self.get_agent_keys():
+            agent = self._agents.get(agent_key)
+            if agent is None:
+                continue
+            if agent.type == "Driver":
+                # dispatch already gave every driver that could get a passenger its route
+                if agent.current_routes:
+                    agent.step_algo()
+                else:
+                    agent.idle_time += 1
+            else:
+                agent.step()
+        self.steps += 1
+        self.time += 1
+
+
+    def __getstate__(self):
+        # the pool stays with the process that started it
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
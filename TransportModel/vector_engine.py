@@ -0,0 +1,330 @@
+import itertools
+import random
+
+import numpy as np
+
+from demand import draw_secondary_id
+
+# StepType values, kept here so the engine does not need mesa
+QUEUE = 1
+CLOSEST = 2
+WAITING = 3
+
+# driver phases
+ABSENT = -1 # padding for runs with fewer drivers than the largest run in the batch
+IDLE = 0
+TO_PICKUP = 1
+TO_DROPOFF = 2
+
+_NEVER = np.iinfo(np.int64).max
+
+
+def _mix(values):
+    # splitmix64 finaliser, a cheap counter based hash for per run activation order
+    values = values.astype(np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+class VectorBatch:
+    """Many single passenger (multi_pass=False) runs stepped together as numpy arrays.
+
+    Each run takes the same parameters as TransportModel (plus an optional iteration) and
+    draws the same demand from seed_int, so both see identical requests. Patience comes from
+    a numpy rng seeded with (seed_int, iteration), and activation order from a hash of the
+    same, so a run gives the same result whichever batch it is in. Runs in one batch must
+    share rate; state arrays are runs x drivers and runs x passenger slots, with slot j
+    holding the j-th request in every run.
+
+    Passengers are picked up in the same way as in Agents.py, including waiting behind an
+    earlier passenger in the same cell. Each step, expired passengers leave first, idle
+    drivers are dispatched in random order, and then all cars pick up, drop off and move.
+    """
+
+    def __init__(self, runs, steps=None):
+        runs = [dict(run) for run in runs]
+        if any(run.get("multi_pass") for run in runs):
+            raise ValueError("vector engine only supports multi_pass=False")
+        if any(getattr(run["strategy"], "value", run["strategy"]) not in (QUEUE, CLOSEST, WAITING) for run in runs):
+            raise ValueError("vector engine only supports the QUEUE, CLOSEST and WAITING strategies")
+        rates = {run["rate"] for run in runs}
+        if len(rates) != 1:
+            raise ValueError("runs in one batch must share rate")
+        if steps is None:
+            steps = max(run.get("total_steps", 0) for run in runs)
+        if not steps:
+            raise ValueError("vector engine needs total_steps or steps to generate demand")
+
+        self.runs = runs
+        self.rate = rates.pop()
+        self.max_steps = steps
+        self.steps = 0
+        self.running = True
+
+        num_runs = len(runs)
+        self.num_drivers = np.array([run["num_drivers"] for run in runs])
+        max_drivers = int(self.num_drivers.max())
+        num_slots = max_drivers + steps // self.rate
+        self.first_arrival = max_drivers # slot of the request made at step rate
+
+        self.strategy = np.array([getattr(run["strategy"], "value", run["strategy"]) for run in runs])[:, None]
+        self.run_key = _mix(np.array([hash((run["seed_int"], run.get("iteration", 0))) & 0xffffffffffffffff
+                                      for run in runs], dtype=np.uint64))[:, None]
+
+        shape = (num_runs, num_slots)
+        self.src_x = np.zeros(shape, dtype=np.int64)
+        self.src_y = np.zeros(shape, dtype=np.int64)
+        self.dest_x = np.zeros(shape, dtype=np.int64)
+        self.dest_y = np.zeros(shape, dtype=np.int64)
+        self.latest_pickup_time = np.zeros(shape, dtype=np.int64)
+        self.secondary_id = np.zeros(shape, dtype=np.int64)
+        self.pickup_time = np.full(shape, -1, dtype=np.int64)
+        self.dropoff_time = np.full(shape, -1, dtype=np.int64)
+        self.waiting = np.zeros(shape, dtype=bool) # in the clients pool
+        self.on_grid = np.zeros(shape, dtype=bool) # waiting at src, even if skipped by dispatch
+        self.request_time = np.zeros(num_slots, dtype=np.int64)
+        self.request_time[max_drivers:] = self.rate * np.arange(1, num_slots - max_drivers + 1)
+
+        shape = (num_runs, max_drivers)
+        self.x = np.zeros(shape, dtype=np.int64)
+        self.y = np.zeros(shape, dtype=np.int64)
+        self.phase = np.full(shape, ABSENT, dtype=np.int64)
+        self.target = np.zeros(shape, dtype=np.int64)
+        self.carrying = np.zeros(shape, dtype=bool)
+        self.steps_taken = np.full(shape, -1, dtype=np.int64)
+        self.idle_time = np.zeros(shape, dtype=np.int64)
+
+        for r, run in enumerate(runs):
+            self._generate(r, run)
+
+        self._lo = 0 # slots below this have all left the grid in every run
+        self._hi = max_drivers # slots below this have been requested
+
+        # drivers look for a passenger as they are created, in creation order
+        self._dispatch(np.broadcast_to(np.arange(max_drivers), shape), self.num_drivers)
+
+
+    def _generate(self, r, run):
+        # draw demand and starting positions in the same order as TransportModel
+        size = run["size"]
+        seed = random.Random(run["seed_int"])
+        rng = np.random.default_rng([run["seed_int"], run.get("iteration", 0)])
+        total_steps = run.get("total_steps", 0)
+        num_range = range(1, total_steps//self.rate + run["num_drivers"] + 1) if total_steps else None
+
+        def request(slot):
+            nonlocal num_range
+            x, y = seed.randrange(size), seed.randrange(size)
+            secondary_id = 0
+            if total_steps:
+                secondary_id, num_range = draw_secondary_id(seed, num_range)
+            dest_x, dest_y = seed.randrange(size), seed.randrange(size)
+            while (dest_x, dest_y) == (x, y):
+                dest_x, dest_y = seed.randrange(size), seed.randrange(size)
+            self.src_x[r, slot], self.src_y[r, slot] = x, y
+            self.dest_x[r, slot], self.dest_y[r, slot] = dest_x, dest_y
+            self.secondary_id[r, slot] = secondary_id
+
+        num_drivers = run["num_drivers"]
+        for slot in range(num_drivers):
+            request(slot)
+        for i in range(num_drivers):
+            self.x[r, i], self.y[r, i] = seed.randrange(size), seed.randrange(size)
+            self.phase[r, i] = IDLE
+        for slot in range(self.first_arrival, self.src_x.shape[1]):
+            request(slot)
+
+        if run["waiting_time"]:
+            patience = rng.integers(run["waiting_time"], run["waiting_time"] + 11, size=self.src_x.shape[1])
+        else:
+            patience = rng.integers(10, 41, size=self.src_x.shape[1])
+        self.latest_pickup_time[r] = self.request_time + patience
+        self.waiting[r, :num_drivers] = True
+        self.on_grid[r, :num_drivers] = True
+
+
+    def _dispatch(self, order, num_idle):
+        # assign a passenger to the idle drivers of every run, one activation rank at a time,
+        # with the same skip rules as set_next_dest
+        lo, hi = self._lo, self._hi
+        pool = self.waiting[:, lo:hi]
+        if not pool.any():
+            return
+        rows = np.arange(len(order))
+        slots = np.arange(lo, hi)
+        src_x, src_y = self.src_x[:, lo:hi], self.src_y[:, lo:hi]
+        latest = self.latest_pickup_time[:, lo:hi]
+        pool = pool.copy()
+
+        for rank in range(int(num_idle.max())):
+            active = (num_idle > rank) & pool.any(axis=1)
+            if not active.any():
+                break
+            driver = order[:, rank]
+            dist = np.abs(src_x - self.x[rows, driver][:, None]) + np.abs(src_y - self.y[rows, driver][:, None])
+            feasible = dist + self.steps <= latest
+
+            # strategy order, ties going to the earliest arrival
+            key = np.where(self.strategy == WAITING, latest,
+                           np.where(self.strategy == QUEUE, self.request_time[lo:hi], dist))
+            key = key * (hi + 1) + slots
+
+            candidates = pool & feasible & active[:, None]
+            chosen = np.argmin(np.where(candidates, key, _NEVER), axis=1)
+            chosen_key = np.where(candidates.any(axis=1), key[rows, chosen], _NEVER)
+
+            # passengers ahead of the chosen one that can't be reached are dropped for good
+            pool &= ~(~feasible & (key < chosen_key[:, None]) & active[:, None])
+            assigned = np.flatnonzero(candidates.any(axis=1))
+            pool[assigned, chosen[assigned]] = False
+            self.phase[assigned, driver[assigned]] = TO_PICKUP
+            self.target[assigned, driver[assigned]] = lo + chosen[assigned]
+
+        self.waiting[:, lo:hi] = pool
+
+
+    def _waypoints(self):
+        to_pickup = self.phase == TO_PICKUP
+        return (np.where(to_pickup, np.take_along_axis(self.src_x, self.target, 1),
+                         np.take_along_axis(self.dest_x, self.target, 1)),
+                np.where(to_pickup, np.take_along_axis(self.src_y, self.target, 1),
+                         np.take_along_axis(self.dest_y, self.target, 1)))
+
+
+    def step(self):
+        lo, hi = self._lo, self._hi
+
+        # passengers leave once past their waiting time
+        expired = self.on_grid[:, lo:hi] & (self.steps > self.latest_pickup_time[:, lo:hi])
+        self.on_grid[:, lo:hi] &= ~expired
+        self.waiting[:, lo:hi] &= ~expired
+
+        # idle drivers pick a passenger in random activation order
+        idle = self.phase == IDLE
+        if idle.any():
+            drivers = np.arange(idle.shape[1])
+            keys = np.where(idle, _mix(self.run_key ^ _mix(np.uint64(self.steps) * np.uint64(idle.shape[1])
+                                                           + drivers.astype(np.uint64))),
+                            np.iinfo(np.uint64).max)
+            self._dispatch(np.argsort(keys, axis=1), idle.sum(axis=1))
+
+        self.idle_time += self.phase == IDLE
+
+        # pick up or drop off at the next waypoint
+        target_x, target_y = self._waypoints()
+        arrived = (self.phase > IDLE) & (self.x == target_x) & (self.y == target_y)
+        if arrived.any():
+            dropping = arrived & (self.phase == TO_DROPOFF)
+            runs, drivers = np.nonzero(dropping)
+            delivered = self.carrying[runs, drivers]
+            self.dropoff_time[runs[delivered], self.target[runs, drivers][delivered]] = self.steps
+            self.phase[dropping] = IDLE
+            self.carrying[dropping] = False
+
+            runs, drivers = np.nonzero(arrived & (self.phase == TO_PICKUP))
+            if len(runs):
+                x, y = self.x[runs, drivers], self.y[runs, drivers]
+                here = (self.on_grid[runs, lo:hi] & (self.src_x[runs, lo:hi] == x[:, None])
+                        & (self.src_y[runs, lo:hi] == y[:, None]))
+                first = np.where(here.any(axis=1), lo + np.argmax(here, axis=1), -1)
+                target = self.target[runs, drivers]
+                picked = first == target
+                self.on_grid[runs[picked], target[picked]] = False
+                self.pickup_time[runs[picked], target[picked]] = self.steps
+                self.carrying[runs[picked], drivers[picked]] = True
+                # a passenger that has left still sends the car on to their destination
+                moving_on = picked | (first == -1)
+                self.phase[runs[moving_on], drivers[moving_on]] = TO_DROPOFF
+
+        # move one cell towards the next waypoint, x first
+        busy = self.phase > IDLE
+        target_x, target_y = self._waypoints()
+        dx = np.where(busy, np.sign(target_x - self.x), 0)
+        dy = np.where(busy & (dx == 0), np.sign(target_y - self.y), 0)
+        self.x += dx
+        self.y += dy
+        self.steps_taken += (dx != 0) | (dy != 0)
+
+        self.steps += 1
+        if self.steps % self.rate == 0 and self._hi < self.src_x.shape[1]:
+            self.waiting[:, self._hi] = True
+            self.on_grid[:, self._hi] = True
+            self._hi += 1
+        while self._lo < self._hi and not self.on_grid[:, self._lo].any():
+            self._lo += 1
+        if self.steps >= self.max_steps:
+            self.running = False
+
+
+    def run(self, steps=None):
+        for _ in range(self.max_steps - self.steps if steps is None else steps):
+            self.step()
+
+
+    def passenger_metrics(self, r):
+        # same metrics as the TransportModel agent reporters, one entry per requested passenger
+        slots = np.r_[np.arange(self.num_drivers[r]), np.arange(self.first_arrival, self._hi)]
+        return {
+            "sec_id": self.secondary_id[r, slots],
+            "request_time": self.request_time[slots],
+            "pickup_time": self.pickup_time[r, slots],
+            "dropoff_time": self.dropoff_time[r, slots],
+            "shortest distance": (np.abs(self.src_x[r, slots] - self.dest_x[r, slots])
+                                  + np.abs(self.src_y[r, slots] - self.dest_y[r, slots])),
+        }
+
+    def driver_metrics(self, r):
+        num_drivers = self.num_drivers[r]
+        return {"Steps": self.steps_taken[r, :num_drivers], "IdleTime": self.idle_time[r, :num_drivers]}
+
+
+class VectorTransportModel(VectorBatch):
+    """Single run of the vector engine, constructed like TransportModel."""
+
+    def __init__(self, num_drivers, size, seed_int, strategy, waiting_time, rate, total_steps=0,
+                 multi_pass=False, iteration=0, steps=None):
+        super().__init__([{"num_drivers": num_drivers, "size": size, "seed_int": seed_int, "strategy": strategy,
+                           "waiting_time": waiting_time, "rate": rate, "total_steps": total_steps,
+                           "multi_pass": multi_pass, "iteration": iteration}], steps)
+
+    def passenger_metrics(self):
+        return super().passenger_metrics(0)
+
+    def driver_metrics(self):
+        return super().driver_metrics(0)
+
+
+def batch_run(parameters, iterations=1, max_steps=1000):
+    """Vector engine counterpart of mesa.batch_run for single passenger sweeps.
+
+    parameters is expanded into every combination like mesa.batch_run. Runs sharing rate are
+    stepped together, and one row is returned per passenger and per driver at the end of each
+    run, with the same columns the analysis notebooks read.
+    """
+    names = list(parameters)
+    values = [value if isinstance(value, (list, tuple, range)) else [value] for value in parameters.values()]
+    runs = []
+    for combination in itertools.product(*values):
+        for iteration in range(iterations):
+            runs.append(dict(zip(names, combination), iteration=iteration))
+
+    groups = {}
+    for run_id, run in enumerate(runs):
+        groups.setdefault(run["rate"], []).append(run_id)
+
+    results = []
+    for run_ids in groups.values():
+        batch = VectorBatch([runs[run_id] for run_id in run_ids], max_steps)
+        batch.run()
+        for r, run_id in enumerate(run_ids):
+            row = dict(runs[run_id], RunId=run_id, Step=batch.steps)
+            drivers = batch.driver_metrics(r)
+            for i in range(batch.num_drivers[r]):
+                results.append(dict(row, AgentID=i, Steps=int(drivers["Steps"][i]),
+                                    IdleTime=int(drivers["IdleTime"][i])))
+            passengers = batch.passenger_metrics(r)
+            for i in range(len(passengers["sec_id"])):
+                results.append(dict(row, AgentID=batch.num_drivers[r] + i,
+                                    **{name: int(column[i]) for name, column in passengers.items()}))
+    return results